@@ -33,8 +33,19 @@ if [[ "$@" == "run" ]]; then
       echo "Received Rancher2 WIKI related variables"
 
       if [ -n "$RANCHER2_SERVER_URL" ] && [ -n "$RANCHER2_CLUSTER_ID" ] && [ -n "$RANCHER2_CLUSTER_NAME" ]; then
+        if [[ "$RANCHER2_DAEMON" == "Yes" ]]; then
+          if [ -z "$RANCHER2_CLUSTERS_TO_MERGE" ]; then
+            echo "Watch Rancher2 cluster data"
+            exec python /run_all_rancher2.py daemon 2>&1
+          fi
+          echo "RANCHER2_DAEMON is ignored on the main instance, the merge runs after the listing"
+        fi
+
         echo "List Rancher2 cluster data"
         timeout $TIMEOUT python /run_all_rancher2.py list 2>&1
+      elif [ -n "$RANCHER2_CLUSTERS_TO_LIST" ]; then
+        echo "List Rancher2 clusters data"
+        timeout $TIMEOUT python /run_all_rancher2.py list 2>&1
       fi
 
       if [ -n "$RANCHER2_CLUSTERS_TO_MERGE" ]; then
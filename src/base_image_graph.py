@@ -0,0 +1,182 @@
+import json
+import logging
+import threading
+from graphlib import CycleError, TopologicalSorter
+
+from textile import render_textile
+
+
+class BaseImageGraph:
+    """
+    Directed graph of the images and the base images they are built FROM,
+    an edge goes from an image to each of its base images.
+
+    The graph is built once per run and shared by all the image checks,
+    node statuses are memoized.
+    """
+
+    def __init__(self):
+        self.edges = {}
+        self.statuses = {}
+        self.expanded = set()
+        self.lock = threading.RLock()
+
+    def claim(self, image):
+        """
+        Returns True the first time it is called for an image, so that the
+        base images of an image are looked up only once
+        """
+        with self.lock:
+            if image in self.expanded:
+                return False
+            self.expanded.add(image)
+            return True
+
+    def add_edges(self, image, base_images):
+        with self.lock:
+            self.expanded.add(image)
+            self.edges.setdefault(image, set()).update(base_images)
+            for base_image in base_images:
+                self.edges.setdefault(base_image, set())
+
+    def bases(self, image):
+        with self.lock:
+            return set(self.edges.get(image, ()))
+
+    def set_status(self, image, result):
+        with self.lock:
+            self.statuses[image] = result
+
+    def find_cycle(self, image, base_images):
+        """
+        Returns the cycle created by adding the image -> base_images edges,
+        as a list of images, or None
+        """
+        with self.lock:
+            for base_image in base_images:
+                path = self._path(base_image, image, set())
+                if path:
+                    return [image] + path
+        return None
+
+    def _path(self, start, end, seen):
+        if start == end:
+            return [end]
+        seen.add(start)
+        for base_image in self.edges.get(start, ()):
+            if base_image not in seen:
+                path = self._path(base_image, end, seen)
+                if path:
+                    return [start] + path
+        return None
+
+    def evaluate(self, check):
+        """
+        Computes the missing node statuses, base images first.
+
+        :param check: callable image -> ImageResult
+        """
+        with self.lock:
+            edges = {image: set(bases) for image, bases in self.edges.items()}
+
+        try:
+            order = list(TopologicalSorter(edges).static_order())
+        except CycleError as exc:
+            logging.error(f"Base images dependency cycle: {' -> '.join(exc.args[1])}")
+            order = list(edges)
+
+        for image in order:
+            with self.lock:
+                if image in self.statuses:
+                    continue
+            try:
+                result = check(image)
+            except Exception:
+                logging.exception(f"Failed to check base image {image}")
+                continue
+            self.set_status(image, result)
+
+    def dependents(self, image):
+        """Returns all the images built on top of image, directly or not"""
+        with self.lock:
+            reverse_edges = {}
+            for node, bases in self.edges.items():
+                for base_image in bases:
+                    reverse_edges.setdefault(base_image, set()).add(node)
+
+        found = set()
+        to_visit = [image]
+        while to_visit:
+            for dependent in reverse_edges.get(to_visit.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    to_visit.append(dependent)
+        return found
+
+    def to_dict(self):
+        """
+        Nodes, edges and the outdated base images sorted by the number of
+        downstream images an upgrade would fix. The base images that could
+        not be checked are listed apart, in errors.
+        """
+        with self.lock:
+            images = sorted(self.edges)
+            statuses = dict(self.statuses)
+
+        nodes = []
+        impact = []
+        errors = []
+        for image in images:
+            result = statuses.get(image)
+            status = result.up_to_date if result else None
+            msg = render_textile(result) if result else ""
+            dependents = self.dependents(image)
+            nodes.append(
+                {
+                    "image": image,
+                    "up_to_date": status,
+                    "state": result.state.value if result else None,
+                    "status": msg,
+                    "bases": sorted(self.bases(image)),
+                    "downstream": len(dependents),
+                }
+            )
+            if result is None or not dependents:
+                continue
+            if result.outdated:
+                impact.append(
+                    {
+                        "image": image,
+                        "status": msg,
+                        "downstream": len(dependents),
+                        "downstream_images": sorted(dependents),
+                    }
+                )
+            elif result.failed:
+                errors.append(
+                    {"image": image, "status": msg, "downstream": len(dependents)}
+                )
+
+        impact.sort(key=lambda item: (-item["downstream"], item["image"]))
+        errors.sort(key=lambda item: (-item["downstream"], item["image"]))
+        return {"nodes": nodes, "impact": impact, "errors": errors}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_dot(self):
+        with self.lock:
+            edges = {image: sorted(bases) for image, bases in self.edges.items()}
+            statuses = dict(self.statuses)
+
+        colors = {True: "green", False: "red", None: "gray"}
+        lines = ["digraph base_images {", "  rankdir=LR;"]
+        for image in sorted(edges):
+            result = statuses.get(image)
+            status = result.up_to_date if result else None
+            lines.append(f'  "{image}" [color={colors[status]}];')
+        for image in sorted(edges):
+            for base_image in edges[image]:
+                lines.append(f'  "{image}" -> "{base_image}";')
+        lines.append("}")
+        return "\n".join(lines)
@@ -0,0 +1,109 @@
+"""
+Replays a set of images through ImageChecker and reports the number of
+registry requests, the wall time and the cache hit rates.
+
+Record the registry responses once:
+
+    python benchmark_image_checker.py -r fixtures.json images.txt
+
+then replay them offline as often as needed:
+
+    python benchmark_image_checker.py -f fixtures.json images.txt
+
+images.txt has one image per line, or is a dumped rancher2 pods draft
+page, in which case the images of the "TODO" rows are used.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+from collections import Counter
+
+from fake_registry import FakeRegistrySession, RecordingSession
+from registry import new_session
+
+
+def read_images(path):
+    images = []
+    with open(path) as f:
+        for line in f.read().splitlines():
+            line = line.strip()
+            if "TODO" in line:
+                columns = line.split("|")
+                if len(columns) > 6:
+                    images.append(columns[6].strip())  # pods page image column
+            elif line and " " not in line and not line.startswith("|"):
+                images.append(line)
+    return images
+
+
+def run(images, session, runs):
+    # imported here so that IMAGE_CACHE_PATH is already set
+    from image_checker import ImageChecker
+
+    for run_number in range(1, runs + 1):
+        requests_before = sum(session.requests.values())
+        start = time.monotonic()
+
+        image_checker = ImageChecker(session=session)
+        results = image_checker.check_many(images)
+
+        elapsed = time.monotonic() - start
+        requests_made = sum(session.requests.values()) - requests_before
+        cache = image_checker.cache
+
+        print(f"Run {run_number}:")
+        print(f"  images: {len(images)} ({len(results)} distinct)")
+        print(f"  registry requests: {requests_made}")
+        print(f"  wall time: {elapsed:.2f}s")
+        states = Counter(result.state.value for result in results.values())
+        print(f"  results: {', '.join(f'{s} {n}' for s, n in sorted(states.items()))}")
+        for kind in sorted(set(cache.hits) | set(cache.misses)):
+            lookups = cache.hits[kind] + cache.misses[kind]
+            print(
+                f"  cache {kind}: {cache.hits[kind]}/{lookups} hits "
+                f"({cache.hits[kind] * 100 / lookups:.0f}%)"
+            )
+
+    print("Requests per host:")
+    for host, count in sorted(session.requests.items()):
+        print(f"  {host}: {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("images", help="file with the images to check")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-f", "--fixtures", help="replay the recorded responses")
+    group.add_argument("-r", "--record", help="record the responses to this file")
+    parser.add_argument(
+        "-n", "--runs", type=int, default=2, help="runs sharing the same cache"
+    )
+    parser.add_argument(
+        "-c", "--cache", help="cache file to use, a new temporary one by default"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    options = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose else logging.WARNING,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+
+    cache_dir = tempfile.mkdtemp()
+    os.environ["IMAGE_CACHE_PATH"] = options.cache or os.path.join(
+        cache_dir, "image_checker.sqlite"
+    )
+
+    if options.record:
+        session = RecordingSession(new_session())
+    else:
+        session = FakeRegistrySession.load(options.fixtures)
+
+    run(read_images(options.images), session, options.runs)
+
+    if options.record:
+        session.save(options.record)
+        print(f"Recorded {len(session.fixtures)} responses to {options.record}")
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+
+class DiskCache:
+    """
+    Small persistent key/value store backed by SQLite.
+
+    Entries are grouped by kind and every kind has its own TTL (in seconds).
+    The total number of entries is capped, the least recently used ones are
+    evicted first. Values must be JSON serializable.
+
+    An empty path disables the cache, all lookups are then misses.
+    """
+
+    def __init__(self, path, ttls=None, max_entries=5000):
+        self.path = path
+        self.ttls = ttls or {}
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = None
+
+        # lookups per kind, for statistics
+        self.hits = Counter()
+        self.misses = Counter()
+
+        if not path:
+            return
+
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+
+            self.connection = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL, "
+                "PRIMARY KEY (kind, key))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+            )
+        except (OSError, sqlite3.Error):
+            logging.exception(f"Could not open cache {path}, continuing without it")
+            self.connection = None
+
+    def get(self, kind, key):
+        """
+        Return the cached value or None if it is missing or expired
+        """
+        if not self.connection:
+            return None
+
+        now = time.time()
+        ttl = self.ttls.get(kind)
+        with self.lock:
+            try:
+                row = self.connection.execute(
+                    "SELECT value, created FROM cache WHERE kind = ? AND key = ?",
+                    (kind, key),
+                ).fetchone()
+                if row is None:
+                    self.misses[kind] += 1
+                    return None
+
+                value, created = row
+                if ttl is not None and now - created > ttl:
+                    self.connection.execute(
+                        "DELETE FROM cache WHERE kind = ? AND key = ?", (kind, key)
+                    )
+                    self.misses[kind] += 1
+                    return None
+
+                self.connection.execute(
+                    "UPDATE cache SET accessed = ? WHERE kind = ? AND key = ?",
+                    (now, kind, key),
+                )
+                self.hits[kind] += 1
+            except sqlite3.Error:
+                logging.exception(f"Failed to read {kind}/{key} from cache")
+                return None
+
+        return json.loads(value)
+
+    def set(self, kind, key, value):
+        if not self.connection:
+            return
+
+        now = time.time()
+        with self.lock:
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO cache (kind, key, value, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (kind, key, json.dumps(value), now, now),
+                )
+                self._evict()
+            except sqlite3.Error:
+                logging.exception(f"Failed to write {kind}/{key} to cache")
+
+    def delete(self, kind, key):
+        if not self.connection:
+            return
+
+        with self.lock:
+            try:
+                self.connection.execute(
+                    "DELETE FROM cache WHERE kind = ? AND key = ?", (kind, key)
+                )
+            except sqlite3.Error:
+                logging.exception(f"Failed to delete {kind}/{key} from cache")
+
+    def _evict(self):
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count <= self.max_entries:
+            return
+
+        self.connection.execute(
+            "DELETE FROM cache WHERE rowid IN "
+            "(SELECT rowid FROM cache ORDER BY accessed LIMIT ?)",
+            (count - self.max_entries,),
+        )
+        logging.debug(
+            f"Evicted {count - self.max_entries} entries from cache {self.path}"
+        )
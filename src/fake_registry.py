@@ -0,0 +1,131 @@
+import json
+import logging
+import threading
+from collections import Counter
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from requests.structures import CaseInsensitiveDict
+from requests.utils import parse_header_links
+
+# Response headers kept in the recorded fixtures
+RECORDED_HEADERS = [
+    "Content-Type",
+    "Docker-Content-Digest",
+    "ETag",
+    "Link",
+    "RateLimit-Limit",
+    "RateLimit-Remaining",
+    "Retry-After",
+]
+
+
+def request_key(method, url, params=None):
+    """
+    Identifies a request in the fixtures: method, url and the sorted query
+    parameters, whether they are part of the url or passed as params
+    """
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query) + [(k, str(v)) for k, v in (params or {}).items()]
+    key = f"{method.upper()} {parts.scheme}://{parts.netloc}{parts.path}"
+    if query:
+        key += "?" + urlencode(sorted(query))
+    return key
+
+
+class RecordedResponse:
+    """The subset of requests.Response used by ImageChecker"""
+
+    def __init__(self, status_code, headers=None, body=""):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.text = body
+        self.content = body.encode()
+
+    def json(self):
+        return json.loads(self.text)
+
+    @property
+    def links(self):
+        links = {}
+        for link in parse_header_links(self.headers.get("Link", "")):
+            links[link.get("rel") or link.get("url")] = link
+        return links
+
+
+class FakeRegistrySession:
+    """
+    In-process stand-in for the registries, serves the responses recorded
+    by RecordingSession. Unknown requests get a 404.
+    """
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def request(self, method, url, params=None, **kwargs):
+        key = request_key(method, url, params)
+        with self.lock:
+            self.requests[urlsplit(url).netloc] += 1
+
+        fixture = self.fixtures.get(key)
+        if fixture is None:
+            logging.debug(f"No fixture for {key}")
+            return RecordedResponse(404, body="{}")
+
+        return RecordedResponse(fixture["status"], fixture["headers"], fixture["body"])
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class RecordingSession:
+    """
+    Wraps a requests session and records every response, so that a run can
+    be replayed offline with FakeRegistrySession
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.fixtures = {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, **kwargs):
+        response = self.session.request(method, url, params=params, **kwargs)
+        headers = {
+            name: response.headers[name]
+            for name in RECORDED_HEADERS
+            if name in response.headers
+        }
+        body = response.text
+        if "/users/login" in url:
+            # do not keep the Docker Hub credentials token in the fixtures
+            body = json.dumps({"token": "recorded-token"})
+
+        with self.lock:
+            self.requests[urlsplit(url).netloc] += 1
+            self.fixtures[request_key(method, url, params)] = {
+                "status": response.status_code,
+                "headers": headers,
+                "body": body,
+            }
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.fixtures, f, indent=1, sort_keys=True)
@@ -2,22 +2,157 @@ import os
 import re
 import json
 import logging
-import requests
-import time
-from natsort import natsorted
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import urljoin
+
+from base_image_graph import BaseImageGraph
+from disk_cache import DiskCache
+from image_result import ImageResult, State
+from registry import (
+    RegistryAccessDenied,
+    RegistryDeferred,
+    RegistryResponseError,
+    RegistryScheduler,
+    RegistryTokenManager,
+    new_session,
+)
+
+
+# Accept header asking the registries for the digest of multi arch images
+MANIFEST_ACCEPT = ", ".join(
+    [
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+    ]
+)
+
+DIGIT_PATTERN = re.compile(r"^v?\d{1,4}$")
+WORD_PATTERN = re.compile(r"^[a-zA-Z0-9]+$")
+NUMBER_PATTERN = re.compile(r"\d+")
+DEVELOP_TAGS = frozenset(["beta", "alpha", "rc", "RC"])
+
+# version: tuple used to order tags of the same flavour
+# flavour: alphabetic pieces of the tag, None when the tag has no '-'
+# prerelease: the tag contains an alpha/beta/rc piece
+# non_semantic: the tag is not considered a semantic version, see parse_tag
+TagInfo = namedtuple("TagInfo", ["version", "flavour", "prerelease", "non_semantic"])
+
+
+@lru_cache(maxsize=65536)
+def parse_tag(tag):
+    """
+    Parse an image tag once, popular images have thousands of tags and the
+    same tags are classified for every image version in use.
+
+    We are considering a semantic version any concatenation of no more
+    than 3 1,2,3-digit numbers separated by a '.' , linked by '-' to
+    none ore many alphanumeric or other 1,2,3-digit numbers '.' separated.
+
+    - we don not accept alpha/beta images
+    - we force the version to start with digit/"v" e.g: redis:rc-alpine3.11 is not valid
+    - we force the version to contain a numerical orderd string e.g.: redis:32bit-stretch is not valid
+    - we allow 'v' starting versions e.g: eeacms/esbootstrap:v3.0.4
+    """
+    pieces = tag.split("-")
+    actual_version = pieces[0].split(".")
+    flavour_pieces = pieces[1:]
+
+    flavour = None
+    if flavour_pieces:
+        flavour = "".join(piece + "-" for piece in pieces if piece.isalpha())
+
+    non_semantic = not all(DIGIT_PATTERN.match(element) for element in actual_version)
+    prerelease = False
+    for piece in flavour_pieces:
+        for element in piece.split("."):
+            if DIGIT_PATTERN.match(element):
+                continue
+            if element in DEVELOP_TAGS:
+                prerelease = True
+            if not WORD_PATTERN.match(element) or element in DEVELOP_TAGS:
+                non_semantic = True
+
+    if non_semantic:
+        version = (tuple(int(n) for n in NUMBER_PATTERN.findall(tag)), ())
+    else:
+        version = (
+            tuple(int(element.lstrip("v")) for element in actual_version),
+            tuple(int(n) for n in NUMBER_PATTERN.findall("-".join(flavour_pieces))),
+        )
+
+    return TagInfo(version, flavour, prerelease, non_semantic)
+
+
+def version_key(version):
+    """Sort key of a tag, as they might contain non-numerics"""
+    return parse_tag(str(version)).version
+
+
+def parse_hub_timestamp(timestamp):
+    """Parse a Docker Hub 'last_updated' value, e.g. 2024-01-31T10:00:00.123456Z"""
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
 
 
 class ImageChecker:
-    def __init__(self):
+    def __init__(self, session=None):
+        """
+        :param session: transport used for all the registry requests, a
+        requests.Session by default (see fake_registry for an offline one)
+        """
+        # Concurrency settings used by check_many
+        self.max_workers = int(os.getenv("IMAGE_CHECKER_WORKERS", 8))
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+        # All registry traffic shares one pooled keep-alive session and is
+        # rate limited per registry host
+        self.session = session or new_session(pool_size=self.max_workers)
+        self.scheduler = RegistryScheduler(
+            self.session,
+            rate=float(os.getenv("IMAGE_CHECKER_REGISTRY_RATE", 10)),
+            burst=int(os.getenv("IMAGE_CHECKER_REGISTRY_BURST", 20)),
+            concurrency=int(os.getenv("IMAGE_CHECKER_REGISTRY_CONCURRENCY", 4)),
+            retries=int(os.getenv("IMAGE_CHECKER_RETRIES", 3)),
+            max_wait=int(os.getenv("IMAGE_CHECKER_MAX_WAIT", 60)),
+        )
+        self.token_manager = RegistryTokenManager(self._get)
+
         self.dockerhub_token = self.get_dockerhub_login_token()
         self.images_cache = {}
         self.images_base_cache = {}
+        self.versions_cache = {}
+        self.repository_locks = {}
+
+        # Persistent cache, shared between runs
+        self.cache = DiskCache(
+            os.getenv("IMAGE_CACHE_PATH", "./cache/image_checker.sqlite"),
+            ttls={
+                "status": int(os.getenv("IMAGE_CACHE_STATUS_TTL", 6 * 3600)),
+                "base": int(os.getenv("IMAGE_CACHE_BASE_TTL", 24 * 3600)),
+                "versions": int(os.getenv("IMAGE_CACHE_VERSIONS_TTL", 12 * 3600)),
+                "tags": int(os.getenv("IMAGE_CACHE_TAGS_TTL", 7 * 24 * 3600)),
+                "verdict": int(os.getenv("IMAGE_CACHE_VERDICT_TTL", 7 * 24 * 3600)),
+                "from": int(os.getenv("IMAGE_CACHE_BASE_TTL", 24 * 3600)),
+            },
+            max_entries=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", 5000)),
+        )
+        # Images and the base images they are built from, for this run
+        self.base_graph = BaseImageGraph()
 
-        self.redmine_error_color = "%{color:red}"
-        self.redmine_minor_color = "%{color:orange}"
-        self.redmine_major_color = "%{color:purple}"
-        self.redmine_ok_color = "%{color:green}"
-        self.redmine_info_color = "%{color:black}"
+        # (kind, image) of the results that were persisted in the cache
+        self.settled_images = set()
+
+        # Reuse the last verdict while the image digest and tags list are unchanged
+        self.digest_mode = os.getenv("IMAGE_CHECKER_DIGEST_MODE", "").lower() in (
+            "yes",
+            "true",
+        )
 
     def get_dockerhub_login_token(self):
         auth_url = "https://hub.docker.com/v2/users/login/"
@@ -26,7 +161,7 @@ class ImageChecker:
             "password": os.getenv("DOCKERHUB_PASS", ""),
         }
 
-        r = requests.post(
+        r = self.session.post(
             auth_url, headers={"Content-Type": "application/json"}, json=data
         )
         if not r.status_code == 200:
@@ -40,272 +175,376 @@ class ImageChecker:
             return
         return token
 
-    def get_image_flavour(self, image_name):
-        if "-" not in image_name:
-            return None
+    def _get(self, url, **kwargs):
+        """
+        GET request sent through the registry scheduler, raises
+        RegistryDeferred when the registry is rate limiting us
+        """
+        return self.scheduler.request("GET", url, **kwargs)
 
-        flavour = ""
-        image_pieces = image_name.split("-")
-        for piece in image_pieces[::-1]:
-            if piece.isalpha():
-                flavour = piece + "-" + flavour
-        return flavour
+    def get_image_flavour(self, image_name):
+        return parse_tag(image_name).flavour
 
     def non_semantic_version(self, version):
         """
-        We are considering a semantic version any concatenation of no more
-        than 3 1,2,3-digit numbers separated by a '.' , linked by '-' to
-        none ore many alphanumeric or other 1,2,3-digit numbers '.' separated.
+        See parse_tag for what is considered a semantic version
+        """
+        return parse_tag(version).non_semantic
 
-        - we don not accept alpha/beta images
-        - we force the version to start with digit/"v" e.g: redis:rc-alpine3.11 is not valid
-        - we force the version to contain a numerical orderd string e.g.: redis:32bit-stretch is not valid
-        - we allow 'v' starting versions e.g: eeacms/esbootstrap:v3.0.4
+    def iter_hub_tags(self, image, since=None, page_size=100):
         """
-        digit_pattern = re.compile(r"^v?\d{1,4}$")
-        word_pattern = re.compile("^[a-zA-Z0-9]+$")
-        develop_tags = ["beta", "alpha", "rc", "RC"]
+        Yields the Docker Hub tag details of a repository, the most recently
+        updated first, following the 'next' links page by page.
 
-        version_pieces = version.split("-")
-        actual_version = version_pieces[0]
-        flavour = version_pieces[1:] if len(version_pieces) > 1 else []
+        :param since: datetime, stop once the tags were last updated before it
+        """
+        if "/" not in image:
+            image = f"library/{image}"
+
+        url = f"https://hub.docker.com/v2/repositories/{image}/tags/"
+        params = {"page_size": page_size, "ordering": "last_updated"}
+        h = {}
+        if self.dockerhub_token:
+            h["Authorization"] = f"Bearer {self.dockerhub_token}"
+
+        while url:
+            r = self._get(url, headers=h, params=params, timeout=60)
+            if r.status_code == 401:
+                raise RegistryAccessDenied(url)
+            try:
+                data = r.json()
+                tags_details = data["results"]
+            except (json.decoder.JSONDecodeError, KeyError):
+                raise RegistryResponseError(url)
+
+            for tag in tags_details:
+                if since and tag.get("last_updated"):
+                    if parse_hub_timestamp(tag["last_updated"]) < since:
+                        return
+                yield tag
+
+            # the next url already contains all the query parameters
+            url, params = data.get("next"), None
+
+    def iter_registry_tags(self, index_url, image, headers, page_size=1000):
+        """
+        Yields the tags of a repository from the registry tags/list endpoint,
+        following the Link headers (n=/last= pagination).
+        """
+        url = f"{index_url}/v2/{image}/tags/list"
+        params = {"n": page_size}
 
-        for element in actual_version.split("."):
-            if not re.match(digit_pattern, element):
-                return True
+        while url:
+            r = self._get(url, headers=headers, params=params, timeout=60)
+            if r.status_code == 401:
+                raise RegistryAccessDenied(url)
+            try:
+                tags = r.json()["tags"]
+            except (json.decoder.JSONDecodeError, KeyError):
+                raise RegistryResponseError(url)
 
-        for piece in flavour:
-            for element in piece.split("."):
-                if not re.match(digit_pattern, element):
-                    if not re.match(word_pattern, element) or element in develop_tags:
-                        return True
+            yield from tags or []
 
-        return False
+            next_link = r.links.get("next", {}).get("url")
+            url, params = (urljoin(index_url, next_link), None) if next_link else (None, None)
 
     def check_non_semantic_version(self, image, version):
         """
         Non semantic images will be checked by a separate logic.
-        We will get the full details on every tag that was created at some point
-        and return the most recent one.
+        We will go through the tags that were created at some point, the most
+        recently updated first, and stop at the first non develop one.
         """
 
-        tags_details_url = f"https://hub.docker.com/v2/repositories/{image}/tags/"
-        h = {"Authorization": f"Bearer {self.dockerhub_token}"}
-        r = requests.get(tags_details_url, headers=h, timeout=60)
-        if r.status_code == 401:
+        latest_tag = None
+        try:
+            for tag in self.iter_hub_tags(image):
+                name = tag["name"]
+                if (
+                    name != "latest"
+                    and name != "master"
+                    and "dev" not in name
+                    and "alpha" not in name
+                    and "beta" not in name
+                ):
+                    latest_tag = name
+                    break
+        except RegistryAccessDenied:
             logging.error(
                 f"{image}: access denied when looking for hub.docker tags creation details"
             )
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}access denied when looking for hub.docker tags creation details%",
+            return ImageResult.error(
+                image, "access denied when looking for hub.docker tags creation details"
             )
-
-        try:
-            tags_details = r.json()["results"]
-        except (json.decoder.JSONDecodeError, KeyError):
+        except RegistryResponseError:
             logging.info(f"{image}: could not fetch tag creation details.")
-            return False, f"{image}: could not fetch tag creation details."
-
-        # Sort tags by their update time and keep the relevant names
-        tags = [(tag["name"], tag["last_updated"]) for tag in tags_details]
-        tags = sorted(tags, key=lambda x: x[0], reverse=True)
-        tags = [
-            tag
-            for tag in tags
-            if (
-                tag[0] != "latest"
-                and tag[0] != "master"
-                and "dev" not in tag[0]
-                and "alpha" not in tag[0]
-                and "beta" not in tag[0]
-            )
-        ]
+            return ImageResult.unavailable(image, "could not fetch tag creation details.")
 
-        if not tags:
+        if not latest_tag:
             logging.error(f"{image}: no non develop tags obtained")
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}no non develop tags obtained%",
-            )
+            return ImageResult.error(image, "no non develop tags obtained")
 
-        if tags[0][0] != version:
-            return (
-                False,
-                f"{image}:{version}: {self.redmine_error_color}non semantic version%",
-            )
-        return (True, f"{image}:{version}: {self.redmine_ok_color}Up to date%")
+        if latest_tag != version:
+            return ImageResult(image, State.NON_SEMANTIC, current=version)
+        return ImageResult(image, State.UP_TO_DATE, current=version)
 
     def filter_potential_image_updates(self, image_name, versions):
-        versions = [v for v in versions if not self.non_semantic_version(v)]
-
         image_tag = image_name.split(":")[1]
-        image_flavour = self.get_image_flavour(image_tag)
-        versions = [v for v in versions if self.get_image_flavour(v) == image_flavour]
-
-        return versions
+        image_flavour = parse_tag(image_tag).flavour
 
-    def get_image_versions(self, image_name):
-        index_url = "https://index.docker.io"
-        auth_url = "https://auth.docker.io/token"
+        tags = [(v, parse_tag(v)) for v in versions]
+        return [
+            v for v, tag in tags if not tag.non_semantic and tag.flavour == image_flavour
+        ]
 
+    def _registry_location(self, image_name):
+        """
+        Returns the registry url, the auth url, the auth service and the
+        repository name of an image (without tag)
+        """
         if image_name.startswith("docker.elastic.co/"):
-            index_url = "https://docker.elastic.co"
-            auth_url = "https://docker-auth.elastic.co/auth"
             image = image_name.replace("docker.elastic.co/", "")
+            return (
+                "https://docker.elastic.co",
+                "https://docker-auth.elastic.co/auth",
+                "token-service",
+                image,
+            )
 
-            payload = {
-                "service": "token-service",
-                "scope": f"repository:{image}:pull",
-            }
-        else:
-            image = image_name
-            if "/" not in image:
-                # Check for docker base images
-                image = f"library/{image}"
-
-            payload = {
-                "service": "registry.docker.io",
-                "scope": f"repository:{image}:pull",
-            }
+        image = image_name
+        if "/" not in image:
+            # Check for docker base images
+            image = f"library/{image}"
+        return (
+            "https://index.docker.io",
+            "https://auth.docker.io/token",
+            "registry.docker.io",
+            image,
+        )
+
+    def _get_new_hub_tags(self, image_name, known_tags):
+        """
+        Returns the tags list of a Docker Hub repository, updating the tags
+        seen on a previous run with the ones pushed since then
+        """
+        since = parse_hub_timestamp(known_tags["since"])
+        new_tags = list(self.iter_hub_tags(image_name, since=since))
+
+        versions = set(known_tags["tags"])
+        versions.update(tag["name"] for tag in new_tags)
+        if new_tags:
+            since = max(parse_hub_timestamp(tag["last_updated"]) for tag in new_tags)
+        logging.debug(f"{image_name}: {len(new_tags)} tags updated since last run")
+
+        return sorted(versions), since
+
+    def get_image_versions(self, image_name):
+        # images sharing a repository wait for the first tags listing
+        with self.lock:
+            repository_lock = self.repository_locks.setdefault(
+                image_name, threading.Lock()
+            )
+        with repository_lock:
+            if image_name in self.versions_cache:
+                return True, self.versions_cache[image_name]
+
+            success, versions = self._get_image_versions(image_name)
+            if success:
+                self.versions_cache[image_name] = versions
+            return success, versions
+
+    def _get_image_versions(self, image_name):
+        cached_versions = self.cache.get("versions", image_name)
+        if cached_versions:
+            return True, cached_versions
+
+        index_url, auth_url, service, image = self._registry_location(image_name)
+
+        # Docker Hub repositories seen before only need the tags pushed since
+        known_tags = None
+        if index_url == "https://index.docker.io":
+            known_tags = self.cache.get("tags", image_name)
+        if known_tags:
+            try:
+                versions, since = self._get_new_hub_tags(image_name, known_tags)
+                self.cache.set(
+                    "tags", image_name, {"tags": versions, "since": since.isoformat()}
+                )
+                self.cache.set("versions", image_name, versions)
+                return True, versions
+            except RegistryDeferred:
+                raise
+            except Exception as exc:
+                logging.info(
+                    f"{image_name}: could not fetch new tags ({exc!r}), listing all tags"
+                )
 
         try:
-            r = requests.get(auth_url, params=payload, timeout=60)
+            token = self.token_manager.get_token(
+                auth_url, service, f"repository:{image}:pull"
+            )
+        except RegistryDeferred:
+            raise
         except Exception as exc:
             logging.error(
                 f"{image}: connection error when looking for image versions: {exc}"
             )
-            time.sleep(30)
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}connection error when looking for image versions%",
+            return False, ImageResult.error(
+                image, "connection error when looking for image versions"
             )
 
-        if not r.status_code == 200:
+        if not token:
             logging.info(f"could not fetch docker hub token for {image_name}.")
-            return False, f"{image_name}: could not fetch docker hub token"
-
-        token = r.json()["token"]
+            return False, ImageResult.unavailable(
+                image_name, "could not fetch docker hub token"
+            )
 
         # Fetch versions
+        listing_start = datetime.now(timezone.utc)
         h = {"Authorization": f"Bearer {token}"}
-        r = requests.get(f"{index_url}/v2/{image}/tags/list", headers=h, timeout=60)
-        if r.status_code == 401:
+        try:
+            versions = list(self.iter_registry_tags(index_url, image, h))
+        except RegistryAccessDenied:
             logging.error(f"{image}: access denied when looking for tags list")
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}access denied when looking for tags list%",
+            return False, ImageResult.error(
+                image, "access denied when looking for tags list"
             )
-        try:
-            versions = r.json()["tags"]
-        except (json.decoder.JSONDecodeError, KeyError):
+        except RegistryResponseError:
             logging.info(f"{image_name}: tags list obtain is empty")
-            return (
-                False,
-                f"{image_name}: {self.redmine_error_color}tags list can not be obtain%",
-            )
+            return False, ImageResult.error(image_name, "tags list can not be obtain")
 
         if not versions:
             logging.info(f"{image_name}: tags list obtained is empty")
-            return (
-                False,
-                f"{image_name}: {self.redmine_error_color}tags list obtained is empty%",
-            )
+            return False, ImageResult.error(image_name, "tags list obtained is empty")
 
+        if index_url == "https://index.docker.io":
+            self.cache.set(
+                "tags",
+                image_name,
+                {"tags": versions, "since": listing_start.isoformat()},
+            )
+        self.cache.set("versions", image_name, versions)
         return True, versions
 
     def get_potential_updates(self, image_name, versions):
         potential_updates = self.filter_potential_image_updates(image_name, versions)
         if not potential_updates:
-            return (
-                False,
-                f"{image_name}: {self.redmine_error_color}no similar flavour tag obtained%",
+            return False, ImageResult.error(
+                image_name, "no similar flavour tag obtained"
             )
 
         return True, potential_updates
 
     def compare_versions(self, image, potential_updates, curr_version):
-        def sanitize_version(version):
-            """Sanitizes version strings, as they might contain non-numerics"""
-            if hasattr(version, "lstrip"):
-                return version.lstrip("v")
-            else:
-                return version
-
-        last_version = natsorted(potential_updates, key=sanitize_version)[-1]
+        last_version = max(potential_updates, key=version_key)
 
         # curr_version might also be in one of the forms:
         # - "2", which actually means the latest "2.x.x"
         # - "2.3", which actually means the latest "2.3.x"
         if last_version == curr_version:
-            return True, f"{image}:{curr_version}: {self.redmine_ok_color}Up to date%"
+            return ImageResult(image, State.UP_TO_DATE, current=curr_version)
         elif "/" not in image and last_version.startswith(curr_version + "."):
             # Takes care of the incomplete curr_version case described above
-            return True, f"{image}:{curr_version}: {self.redmine_ok_color}Up to date%"
+            return ImageResult(image, State.UP_TO_DATE, current=curr_version)
         else:
             curr_major = curr_version.split(".")[0]
             last_major = last_version.split(".")[0]
 
             if curr_major == last_major:
-                return (
-                    False,
-                    f"{image}:{curr_version}: {self.redmine_minor_color}minor upgrade to {last_version}%",
+                return ImageResult(
+                    image,
+                    State.MINOR_UPGRADE,
+                    current=curr_version,
+                    latest_minor=last_version,
                 )
             else:
-                status = f"{image}:{curr_version}: {self.redmine_major_color}major upgrade to {last_version}%"
-
+                last_minor_version = None
                 same_major_updates = [
                     v for v in potential_updates if v.split(".")[0] == curr_major
                 ]
                 if same_major_updates:
-                    last_minor_version = natsorted(same_major_updates)[-1]
-
-                    if last_minor_version and last_minor_version != curr_version:
-                        status += f"; {self.redmine_minor_color}minor upgrade to {image}:{last_minor_version}%"
-                return False, status
+                    last_minor_version = max(same_major_updates, key=version_key)
+                    if last_minor_version == curr_version:
+                        last_minor_version = None
+
+                return ImageResult(
+                    image,
+                    State.MAJOR_UPGRADE,
+                    current=curr_version,
+                    latest_minor=last_minor_version,
+                    latest_major=last_version,
+                )
 
-    """
-        Returns a boolean (true = up to date, false = otherwise) and a message.
-    """
+    def _cached_results(self, kind, key):
+        """
+        Returns the results persisted under kind/key, None if there are none
+        or if they were stored in an older format
+        """
+        cached = self.cache.get(kind, key)
+        if not cached:
+            return None
+        try:
+            return [ImageResult.from_compact(data) for data in cached]
+        except ValueError:
+            logging.debug(f"{key}: ignoring outdated {kind} cache entry")
+            return None
 
     def check_image_status(self, image_name):
+        """
+        Returns the ImageResult of the image itself, without base images
+        """
         if image_name.startswith("docker.io/"):
             image_name = image_name.replace("docker.io/", "")
 
         logging.debug(f"processing image {image_name}")
 
         if image_name in self.images_cache:
-            status, msg = self.images_cache[image_name]
+            return self.images_cache[image_name]
+
+        cached = self._cached_results("status", image_name)
+        if cached:
+            self.images_cache[image_name] = cached[0]
+            self.settled_images.add(("status", image_name))
+            return cached[0]
+
+        # Only verdicts computed from a successful registry lookup are
+        # persisted, transient errors are retried on the next run
+        persist = False
+        if ":" not in image_name or image_name.split(":")[1] == "latest":
+            result = ImageResult.error(image_name, "'latest' tag is not upgradeable")
+            persist = True
         else:
-            if ":" not in image_name or image_name.split(":")[1] == "latest":
-                status = False
-                msg = f"{image_name}: {self.redmine_error_color}'latest' tag is not upgradeable%"
+            image, curr_version = image_name.split(":", 1)
+            if self.non_semantic_version(curr_version):
+                logging.info(f"{image_name}: non semantic version tag")
+                result = self.check_non_semantic_version(image, curr_version)
             else:
-                image, curr_version = image_name.split(":", 1)
-                if self.non_semantic_version(curr_version):
-                    logging.info(f"{image_name}: non semantic version tag")
-                    status, msg = self.check_non_semantic_version(image, curr_version)
+                success, versions = self.get_image_versions(image)
+                if not success:
+                    result = versions
                 else:
-                    success, versions = self.get_image_versions(image)
+                    persist = True
+                    success, potential_updates = self.get_potential_updates(
+                        image_name, versions
+                    )
                     if not success:
-                        status = False
-                        msg = versions
+                        result = potential_updates
                     else:
-                        success, potential_updates = self.get_potential_updates(
-                            image_name, versions
+                        result = self.compare_versions(
+                            image, potential_updates, curr_version
                         )
-                        if not success:
-                            status = False
-                            msg = potential_updates
-                        else:
-                            status, msg = self.compare_versions(
-                                image, potential_updates, curr_version
-                            )
-            self.images_cache[image_name] = (status, msg)
+        self.images_cache[image_name] = result
+        if persist:
+            self.cache.set("status", image_name, [result.to_compact()])
+            self.settled_images.add(("status", image_name))
 
-        return status, msg
+        return result
 
     def check_base_image(self, image):
+        """
+        Returns the ImageResults of the images the image is built FROM, a
+        single error result if they could not be found, None if the image
+        is not one of ours
+        """
         if not self.dockerhub_token:
             return
 
@@ -317,8 +556,97 @@ class ImageChecker:
             return
 
         if image in self.images_base_cache:
-            base_status, base_msg = self.images_base_cache[image]
-            return base_status, base_msg
+            return self.images_base_cache[image]
+
+        cached = self._cached_results("base", image)
+        if cached:
+            base_results = tuple(cached)
+            self.images_base_cache[image] = base_results
+            self.settled_images.add(("base", image))
+            self._add_cached_base_images_to_graph(image)
+            return base_results
+
+        resp = self._get_base_images(image)
+        if not resp:
+            return
+        success, base_images = resp
+        if not success:
+            return (base_images,)
+
+        cycle = self.base_graph.find_cycle(image, base_images)
+        if cycle:
+            logging.error(f"{image}: base images cycle {' -> '.join(cycle)}")
+            return (
+                ImageResult.error(image, f"base images cycle {' -> '.join(cycle)}"),
+            )
+        self.base_graph.add_edges(image, base_images)
+        self._add_base_images_to_graph(base_images)
+
+        base_results = []
+        # the base results are only persisted if all of them were, transient
+        # errors of a base image are retried on the next run
+        persist = True
+        for base_image in sorted(base_images):
+            result = self.check_image_status(base_image)
+            self.base_graph.set_status(base_image, result)
+            base_results.append(result)
+            persist &= (
+                "status",
+                base_image.removeprefix("docker.io/"),
+            ) in self.settled_images
+        base_results = tuple(base_results)
+
+        self.images_base_cache[image] = base_results
+        if persist:
+            self.cache.set(
+                "base", image, [result.to_compact() for result in base_results]
+            )
+            self.settled_images.add(("base", image))
+
+        return base_results
+
+    def _add_cached_base_images_to_graph(self, image):
+        cached_from = self.cache.get("from", image)
+        if cached_from:
+            self.base_graph.add_edges(image, cached_from)
+            self._add_base_images_to_graph(cached_from)
+
+    def _add_base_images_to_graph(self, images):
+        """
+        Adds the FROM relations of our own base images to the graph, each
+        image is looked up once per run
+        """
+        to_visit = [image for image in images if image.startswith("eeacms/")]
+        while to_visit:
+            image = to_visit.pop()
+            if not self.base_graph.claim(image):
+                continue
+
+            resp = self._get_base_images(image)
+            if not resp or not resp[0]:
+                continue
+
+            base_images = resp[1]
+            cycle = self.base_graph.find_cycle(image, base_images)
+            if cycle:
+                logging.error(f"{image}: base images cycle {' -> '.join(cycle)}")
+                continue
+
+            self.base_graph.add_edges(image, base_images)
+            to_visit.extend(b for b in base_images if b.startswith("eeacms/"))
+
+    def _get_base_images(self, image):
+        """
+        Returns the images used in the FROM statements of the Dockerfile
+        the image was built from, as (True, base images) or (False, error
+        message), None if there is nothing to check
+        """
+        if not self.dockerhub_token:
+            return
+
+        cached_from = self.cache.get("from", image)
+        if cached_from:
+            return True, set(cached_from)
 
         full_image_name, version = image, "latest"
         if ":" in image:
@@ -330,29 +658,28 @@ class ImageChecker:
         build_list_url = f"https://hub.docker.com/api/audit/v1/action/?include_related=true&limit=500&object=%2Fapi%2Frepo%2Fv1%2Frepository%2F{repo}%2F{image_name}%2F"
         h = {"Authorization": f"Bearer {self.dockerhub_token}"}
         try:
-            r = requests.get(build_list_url, headers=h, timeout=60)
+            r = self._get(build_list_url, headers=h, timeout=60)
+        except RegistryDeferred:
+            raise
         except Exception as exc:
             logging.error(
                 f"{image}: connection error when looking for base image: {exc}"
             )
-            time.sleep(30)
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}connection error when looking for base image%",
+            return False, ImageResult.error(
+                image, "connection error when looking for base image"
             )
 
         if r.status_code == 401:
             logging.error(f"{image}: access denied when looking for base image")
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}access denied when looking for base image%",
+            return False, ImageResult.error(
+                image, "access denied when looking for base image"
             )
 
         try:
             history = r.json()["objects"]
         except (json.decoder.JSONDecodeError, KeyError):
             logging.info(f"{image}: could not fetch build history.")
-            return False, f"{image}: could not fetch build history."
+            return False, ImageResult.unavailable(image, "could not fetch build history.")
 
         version_uri = None
         for item in history:
@@ -365,48 +692,45 @@ class ImageChecker:
 
             success, versions = self.get_image_versions(full_image_name)
             if not success:
-                logging.info(f"{versions}")
-                return (False, f"{versions}")
+                logging.info(f"{versions.image}: {versions.detail}")
+                return False, versions
 
             if version in versions:
                 logging.info(
                     f"{image}: tag {version} was built externally, no Dockerfile available."
                 )
-                return (
-                    False,
-                    f"{image}: {self.redmine_info_color} was built externally, no Dockerfile available.%",
+                return False, ImageResult(
+                    image,
+                    State.INFO,
+                    detail="was built externally, no Dockerfile available.",
                 )
             else:
                 logging.info(f"{image}: could not find tag {version} in build history.")
-                return (
-                    False,
-                    f"{image}: {self.redmine_error_color}could not find tag {version} in build history.%",
+                return False, ImageResult.error(
+                    image, f"could not find tag {version} in build history."
                 )
 
         # Get build details
-        r = requests.get(f"https://hub.docker.com{version_uri}", headers=h, timeout=60)
+        r = self._get(f"https://hub.docker.com{version_uri}", headers=h, timeout=60)
         if r.status_code == 401:
             logging.error(
                 f"{image}: access denied when looking for base image build details"
             )
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}access denied when looking for base image build details%",
+            return False, ImageResult.error(
+                image, "access denied when looking for base image build details"
             )
         try:
             dockerfile = r.json()["dockerfile"]
         except (json.decoder.JSONDecodeError, KeyError):
             logging.info(f"{image}: Dockerfile is not available in build history")
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}Dockerfile is not available in build history%",
+            return False, ImageResult.error(
+                image, "Dockerfile is not available in build history"
             )
 
         if "FROM" not in dockerfile:
             logging.info(f"{image}: can't find FROM statement in dockerfile")
-            return (
-                False,
-                f"{image}: {self.redmine_error_color}can't find FROM statement in Dockerfile%",
+            return False, ImageResult.error(
+                image, "can't find FROM statement in Dockerfile"
             )
 
         base_images = set()
@@ -415,36 +739,169 @@ class ImageChecker:
                 base_image = line.replace("FROM", "").strip().split()[0]
                 base_images.add(base_image)
 
-        base_status, base_msg = False, ""
-        for base_image in base_images:
-            status, msg = False, ""
-            if not image.startswith("eeacms/"):
-                recursive_resp = self.check_base_image(base_image)
-                if recursive_resp:
-                    status, msg = recursive_resp
-            else:
-                status, msg = self.check_image_status(base_image)
+        self.cache.set("from", image, sorted(base_images))
+        return True, base_images
 
-            base_status |= status
-            base_msg += f"{msg} "
+    def export_base_graph(self, directory):
+        """
+        Writes the base images graph of this run as base_images.json and
+        base_images.dot, the JSON lists the outdated base images by the
+        number of downstream images an upgrade would fix
+        """
+        self.base_graph.evaluate(self.check_image_status)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "base_images.json"), "w") as f:
+            f.write(self.base_graph.to_json())
+        with open(os.path.join(directory, "base_images.dot"), "w") as f:
+            f.write(self.base_graph.to_dot())
+        logging.info(f"Base images graph written to {directory}")
+
+    def check_image_and_base_status(self, image_name):
+        """
+        Concurrent calls for the same image wait for the first one to finish
+        instead of querying the registries again.
+        """
+        with self.lock:
+            future = self.in_flight.get(image_name)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.in_flight[image_name] = future
 
-        self.images_base_cache[image] = (base_status, base_msg)
+        if not is_owner:
+            return future.result()
 
-        return base_status, base_msg
+        try:
+            result = self._check_image_and_base_status(image_name)
+            future.set_result(result)
+            return result
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[image_name]
 
-    def check_image_and_base_status(self, image_name):
+    def check_many(self, image_names):
+        """
+        Check several images in parallel, each distinct image is checked once.
+
+        :param image_names: iterable of image names
+        :return: dict image name -> ImageResult
+        """
+        unique_names = list(dict.fromkeys(image_names))
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                image_name: executor.submit(
+                    self.check_image_and_base_status, image_name
+                )
+                for image_name in unique_names
+            }
+            for image_name, future in futures.items():
+                try:
+                    results[image_name] = future.result()
+                except Exception:
+                    logging.exception(f"{image_name}: failed to check image status")
+                    results[image_name] = ImageResult.error(
+                        image_name, "could not check image status"
+                    )
+
+        return results
+
+    def _check_image_and_base_status(self, image_name):
 
         if "@sha256" in image_name:
-            return False, f"N/A - tag is encoded, could not check it"
+            return ImageResult(
+                image_name,
+                State.NOT_CHECKED,
+                detail="N/A - tag is encoded, could not check it",
+            )
+
+        try:
+            return self._check_image_and_base(image_name)
+        except RegistryDeferred as exc:
+            # nothing was cached, the image is checked again on the next run
+            logging.warning(f"{image_name}: check deferred, {exc}")
+            return ImageResult(image_name, State.DEFERRED)
 
-        image_status, image_msg = self.check_image_status(image_name)
+    def _image_fingerprint(self, image_name):
+        """
+        Returns the manifest digest of the image and a fingerprint of its
+        repository tags list, or None if the registry does not provide them.
+        Costs a HEAD request on the manifest and one on the tags list.
+        """
+        if ":" not in image_name:
+            return None
+
+        repository, tag = image_name.split(":", 1)
+        index_url, auth_url, service, image = self._registry_location(repository)
+        token = self.token_manager.get_token(
+            auth_url, service, f"repository:{image}:pull"
+        )
+        if not token:
+            return None
+
+        h = {"Authorization": f"Bearer {token}", "Accept": MANIFEST_ACCEPT}
+        r = self.scheduler.request(
+            "HEAD", f"{index_url}/v2/{image}/manifests/{tag}", headers=h, timeout=60
+        )
+        digest = r.headers.get("Docker-Content-Digest")
+        if r.status_code != 200 or not digest:
+            return None
+
+        h = {"Authorization": f"Bearer {token}"}
+        r = self.scheduler.request(
+            "HEAD", f"{index_url}/v2/{image}/tags/list", headers=h, timeout=60
+        )
+        tags_fingerprint = r.headers.get("ETag") if r.status_code == 200 else None
+        if not tags_fingerprint and index_url == "https://index.docker.io":
+            # Docker Hub does not always send an ETag, use the last pushed tag
+            last_tag = next(self.iter_hub_tags(repository, page_size=1), None)
+            if last_tag:
+                tags_fingerprint = f"{last_tag['name']}@{last_tag['last_updated']}"
+        if not tags_fingerprint:
+            return None
+
+        return [digest, tags_fingerprint]
+
+    def _check_image_and_base(self, image_name):
+        if image_name.startswith("docker.io/"):
+            image_name = image_name.replace("docker.io/", "")
+
+        fingerprint = None
+        if self.digest_mode:
+            try:
+                fingerprint = self._image_fingerprint(image_name)
+            except (RegistryDeferred, RegistryAccessDenied, RegistryResponseError):
+                pass
+            except Exception as exc:
+                logging.info(f"{image_name}: could not fetch image digest: {exc}")
+
+            verdict = self.cache.get("verdict", image_name)
+            if fingerprint and verdict and verdict["fingerprint"] == fingerprint:
+                logging.debug(f"{image_name}: unchanged since last run")
+                self._add_cached_base_images_to_graph(image_name)
+                try:
+                    return ImageResult.from_compact(verdict["result"])
+                except (KeyError, ValueError):
+                    pass
+
+        result = self.check_image_status(image_name)
+        settled = ("status", image_name) in self.settled_images
 
         if "/" in image_name:
             # Image is not a base image already
-            base_resp = self.check_base_image(image_name)
-            if base_resp:
-                base_status, base_msg = base_resp
-                image_status |= base_status
-                image_msg += f"\n{base_msg}"
+            base_results = self.check_base_image(image_name)
+            if base_results:
+                result = result.with_bases(base_results)
+                settled &= ("base", image_name) in self.settled_images
+
+        if fingerprint and settled:
+            self.cache.set(
+                "verdict",
+                image_name,
+                {"fingerprint": fingerprint, "result": result.to_compact()},
+            )
 
-        return image_status, image_msg
+        return result
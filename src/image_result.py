@@ -0,0 +1,141 @@
+from enum import Enum
+
+
+class State(Enum):
+    UP_TO_DATE = "ok"
+    MINOR_UPGRADE = "minor"
+    MAJOR_UPGRADE = "major"
+    NON_SEMANTIC = "non_semantic"
+    ERROR = "error"
+    # the registry details could not be fetched, an error shown uncolored
+    UNAVAILABLE = "unavailable"
+    INFO = "info"
+    DEFERRED = "deferred"
+    NOT_CHECKED = "not_checked"
+
+
+class ImageResult:
+    """
+    Outcome of an image check, independent of the output format (see
+    textile.render_textile for the Redmine one).
+
+    image: the image name, or the repository the error is about
+    current: the tag in use, None when it is not relevant for the message
+    latest_minor: newest tag of the same major version, if an upgrade
+    latest_major: newest tag of a newer major version, if an upgrade
+    detail: the error or info message
+    bases: results of the base images, None if they were not checked
+    """
+
+    __slots__ = (
+        "image",
+        "current",
+        "latest_minor",
+        "latest_major",
+        "state",
+        "detail",
+        "bases",
+    )
+
+    def __init__(
+        self,
+        image,
+        state,
+        current=None,
+        latest_minor=None,
+        latest_major=None,
+        detail=None,
+        bases=None,
+    ):
+        self.image = image
+        self.state = state
+        self.current = current
+        self.latest_minor = latest_minor
+        self.latest_major = latest_major
+        self.detail = detail
+        self.bases = bases
+
+    @classmethod
+    def error(cls, image, detail):
+        return cls(image, State.ERROR, detail=detail)
+
+    @classmethod
+    def unavailable(cls, image, detail):
+        return cls(image, State.UNAVAILABLE, detail=detail)
+
+    @property
+    def up_to_date(self):
+        """
+        The image or one of its base images is up to date, the boolean the
+        pages used to return along with the message
+        """
+        return self.state is State.UP_TO_DATE or any(
+            base.up_to_date for base in self.bases or ()
+        )
+
+    @property
+    def outdated(self):
+        """A newer tag of the image itself is available"""
+        return self.state in (
+            State.MINOR_UPGRADE,
+            State.MAJOR_UPGRADE,
+            State.NON_SEMANTIC,
+        )
+
+    @property
+    def failed(self):
+        """The image could not be checked"""
+        return self.state in (State.ERROR, State.UNAVAILABLE)
+
+    def with_bases(self, bases):
+        return ImageResult(
+            self.image,
+            self.state,
+            self.current,
+            self.latest_minor,
+            self.latest_major,
+            self.detail,
+            tuple(bases),
+        )
+
+    def to_compact(self):
+        """JSON serializable form, used by the persistent cache"""
+        bases = None
+        if self.bases is not None:
+            bases = [base.to_compact() for base in self.bases]
+        return [
+            self.image,
+            self.state.value,
+            self.current,
+            self.latest_minor,
+            self.latest_major,
+            self.detail,
+            bases,
+        ]
+
+    @classmethod
+    def from_compact(cls, data):
+        """
+        Inverse of to_compact, raises ValueError for data that was not
+        written by to_compact (e.g. by an older version)
+        """
+        try:
+            image, state, current, latest_minor, latest_major, detail, bases = data
+            if bases is not None:
+                bases = tuple(cls.from_compact(base) for base in bases)
+            return cls(
+                image, State(state), current, latest_minor, latest_major, detail, bases
+            )
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f"not a compact image result: {data!r}") from exc
+
+    def __eq__(self, other):
+        if not isinstance(other, ImageResult):
+            return NotImplemented
+        return self.to_compact() == other.to_compact()
+
+    def __hash__(self):
+        return hash((self.image, self.state, self.current))
+
+    def __repr__(self):
+        return f"ImageResult({self.to_compact()!r})"
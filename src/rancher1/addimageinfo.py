@@ -5,6 +5,8 @@ import sys
 import os
 import logging
 
+from textile import render_status
+
 svnuser = os.getenv("SVN_USER", "")
 svnpassword = os.getenv("SVN_PASSWORD", "")
 github_token = os.getenv("GITHUB_TOKEN", "")
@@ -116,11 +118,12 @@ def get_docker_images(urls):
 def generate_images_text(docker_images, image_checker):
     text = ""
     update_section = False
+    images_status = image_checker.check_many(docker_images)
     for name in sorted(docker_images):
         text = text + '* *"' + name + '":' + docker_images[name][1] + "*"
         if docker_images[name][0]:
             text = text + ' | "Source code":' + docker_images[name][0]
-        update_needed, update_msg = image_checker.check_image_and_base_status(name)
+        update_needed, update_msg = render_status(images_status[name])
         update_section |= update_needed
         text = text + " | " + update_msg + "\n"
 
@@ -16,6 +16,7 @@ from urllib.parse import urlparse
 from redminelib import Redmine
 
 from image_checker import ImageChecker
+from textile import render_status
 
 
 def getKey(instance):
@@ -126,6 +127,14 @@ class Discover(object):
         envLimit = 0
         envTotal = 0
         envText = []
+
+        # resolve all images at once, in parallel
+        images_status = self.image_checker.check_many(
+            container["imageUuid"][7:]
+            for containers in self.containers.values()
+            for container in containers
+        )
+
         for hostId, containers in sorted(self.containers.items()):
             host = self.hosts[hostId]
             totalReserved = 0
@@ -157,9 +166,7 @@ class Discover(object):
 
                 host = self.hosts[container["hostId"]]
 
-                update_status, update_msg = (
-                    self.image_checker.check_image_and_base_status(imageName[7:])
-                )
+                update_status, update_msg = render_status(images_status[imageName[7:]])
 
                 envText.append(
                     '| {} | "{}":{} | {} | {} |>. {} |>. {} |>. {} |'.format(
@@ -1,34 +1,119 @@
-import glob
+import hashlib
+import io
 import json
 import logging
 import os
 import requests
-import shutil
+import re
 import tarfile
+import threading
+import time
 import yaml
+from collections import defaultdict
 
 from rancher2.auth import RedmineClient
+from textile import render_status, render_textile
 
 log = logging.getLogger(__name__)
 
 ARCHIVES_DIR = "./archives/"
-EXTRACTION_DIR = "./source_files/"
+# total size of the chart archives kept in ARCHIVES_DIR
+ARCHIVES_MAX_SIZE = int(os.getenv("HELM_ARCHIVES_CACHE_SIZE_MB", 200)) * 1024 * 1024
 
+# seconds the chart versions index is reused, see get_chart_index
+CHART_INDEX_MAX_AGE = 600
+CLUSTER_HEADING = re.compile(r'^h3\. Cluster: "([^"]+)"')
 
-def get_chart_version(chart_name):
+_chart_index = None
+_chart_index_time = 0
+_chart_index_lock = threading.Lock()
+
+# (chart name, version) -> (chart data, images) of the charts already read
+_chart_images = {}
+
+
+def _apps_from_page_text(text):
+    """The apps of a merged apps page without data, from its tables"""
+    cluster = ""
+    for line in text.splitlines():
+        match = CLUSTER_HEADING.match(line)
+        if match:
+            cluster = match.group(1)
+            continue
+        columns = line.split("|")
+        if len(columns) > 4 and not columns[3].strip().startswith("_."):
+            yield {
+                "chart": columns[3].strip(),
+                "version": columns[4].strip(),
+                "cluster": cluster,
+            }
+
+
+def _build_chart_index():
+    """
+    Reads the merged apps data, or the merged apps page if it has none.
+    Returns None if neither could be read.
+    """
     redmineClient = RedmineClient()
     try:
-        text = redmineClient.get_page_text(redmineClient.apps_page)
+        # the merged pages are only rewritten when they change
+        data = redmineClient.get_page_data(redmineClient.apps_page, check_date=False)
+        if data is not None:
+            apps = data.get("apps", [])
+        else:
+            # apps page merged before its data was published
+            text = redmineClient.get_page_text(redmineClient.apps_page, check_date=False)
+            if not text:
+                return None
+            apps = _apps_from_page_text(text)
     except Exception:
-        log.exception("Failed to get apps page for chart version lookup")
-        return ""
+        log.exception("Failed to get apps data for chart version lookup")
+        return None
+
+    index = defaultdict(dict)
+    for app in apps:
+        if not app.get("chart") or not app.get("version"):
+            continue
+        versions = index[app["chart"]].setdefault(app.get("cluster", ""), [])
+        if app["version"] not in versions:
+            versions.append(app["version"])
+    log.info("Indexed the deployed versions of %d charts", len(index))
+    return index
+
+
+def get_chart_index():
+    """
+    chart name -> {cluster: deployed versions}, built once from the merged
+    apps data and shared by the lookups of the next CHART_INDEX_MAX_AGE
+    seconds, i.e. of the run. An index that could not be read is kept as
+    empty for as long, the lookups don't retry the wiki on every chart
+    """
+    global _chart_index, _chart_index_time
+    with _chart_index_lock:
+        if (
+            _chart_index is None
+            or time.monotonic() - _chart_index_time > CHART_INDEX_MAX_AGE
+        ):
+            index = _build_chart_index()
+            if index is None:
+                log.warning(
+                    "No chart index, the chart versions are unknown for %d seconds",
+                    CHART_INDEX_MAX_AGE,
+                )
+                index = {}
+            _chart_index, _chart_index_time = index, time.monotonic()
+        return _chart_index
+
+
+def get_chart_versions(chart_name):
+    """The deployed versions of a chart, by cluster"""
+    return get_chart_index().get(chart_name, {})
 
-    for line in text.splitlines():
-        columns = line.split("|")
-        if len(columns) > 3 and chart_name == columns[3].strip():
-            chart_version = columns[4].strip()
-            return chart_version
 
+def get_chart_version(chart_name):
+    """The version of the chart on the first cluster it is deployed on"""
+    for versions in get_chart_versions(chart_name).values():
+        return versions[0]
     return ""
 
 
@@ -61,18 +146,125 @@ def extract_non_eea_images(subchart):
         return []
 
 
-def extract_images(url, chart_data_all_versions, version=None):
-    # check if link is EEA helm chart
+def _archive_path(chart_data):
+    """
+    Path of the chart archive in the cache, named after its digest in
+    index.yaml so that a republished archive is not mistaken for the old one
+    """
+    digest = chart_data.get("digest")
+    if digest:
+        return os.path.join(ARCHIVES_DIR, f"{digest}.tgz")
+    archive_name = os.path.basename(chart_data.get("urls", [""])[0])
+    return os.path.join(ARCHIVES_DIR, archive_name)
+
+
+def _evict_archives():
+    """Deletes the least recently used archives above ARCHIVES_MAX_SIZE"""
     try:
-        response = requests.get(url, timeout=60)
-    except requests.RequestException:
-        log.exception("Network error fetching helm chart %s", url)
-        return {}, []
+        entries = [entry for entry in os.scandir(ARCHIVES_DIR) if entry.is_file()]
+    except OSError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total_size = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total_size <= ARCHIVES_MAX_SIZE:
+            break
+        size = entry.stat().st_size
+        try:
+            os.remove(entry.path)
+            total_size -= size
+            log.info("Evicted chart archive %s", entry.name)
+        except OSError:
+            log.warning("Failed to evict chart archive %s", entry.path)
+
+
+def _get_archive(chart_data):
+    """
+    The content of the chart archive, from the cache or downloaded, None if
+    it could not be downloaded or does not match its digest in index.yaml
+    """
+    archive_path = _archive_path(chart_data)
+    try:
+        with open(archive_path, "rb") as f:
+            content = f.read()
+        # mark it as recently used, for the eviction
+        os.utime(archive_path)
+        return content
+    except OSError:
+        pass
 
+    source_files_archive = chart_data.get("urls", [""])[0]
+    response = requests.get(f"https://eea.github.io/helm-charts/{source_files_archive}", timeout=60)
     if response.status_code != 200:
-        log.warning("Helm chart not found, skipping %s", url)
+        return None
+    content = response.content
+
+    digest = chart_data.get("digest")
+    if digest and hashlib.sha256(content).hexdigest() != digest:
+        log.warning("Digest mismatch for chart archive %s, skipping it", source_files_archive)
+        return None
+
+    try:
+        os.makedirs(ARCHIVES_DIR, exist_ok=True)
+        with open(archive_path, "wb") as f:
+            f.write(content)
+        _evict_archives()
+    except OSError:
+        log.warning("Failed to cache chart archive %s", source_files_archive)
+    return content
+
+
+def _read_chart_files(content, chart_name):
+    """
+    values.yaml and the templates/*.yaml texts of a chart archive, read in
+    memory without extracting the archive
+    """
+    values_text = None
+    templates = {}
+    with tarfile.open(fileobj=io.BytesIO(content), mode="r:gz") as archive_file:
+        for member in archive_file:
+            if not member.isfile():
+                continue
+            if member.name == f"{chart_name}/values.yaml":
+                values_text = archive_file.extractfile(member).read().decode()
+            elif (
+                os.path.dirname(member.name) == f"{chart_name}/templates"
+                and member.name.endswith(".yaml")
+            ):
+                try:
+                    templates[member.name] = archive_file.extractfile(member).read().decode()
+                except (OSError, UnicodeDecodeError):
+                    log.warning("Failed to read template file %s", member.name)
+    return values_text, templates
+
+
+def _parse_chart_images(content, chart_data):
+    chart_name = chart_data.get("name", "unknown")
+    values_text, templates = _read_chart_files(content, chart_name)
+    if values_text is None:
+        log.warning("No values.yaml in the archive of chart %s", chart_name)
         return {}, []
 
+    # get the main docker image under image: repository:
+    values_dict = yaml.load(values_text, Loader=yaml.FullLoader)
+    app_version = chart_data.get('appVersion', chart_data.get('version', 'version-unknown'))
+
+    image_cfg = values_dict.get("image")
+    if not image_cfg or "repository" not in image_cfg:
+        return {}, []
+
+    images = [f"{image_cfg['repository']}:{app_version}"]
+
+    # get all images found in templates/
+    for file_path in sorted(templates):
+        for line in templates[file_path].splitlines():
+            if " image: " in line and "{{" not in line:
+                images.append(line)
+
+    return chart_data, images
+
+
+def extract_images(url, chart_data_all_versions, version=None):
     # get data for this chart version or get latest
     chart_data = chart_data_all_versions[0]
     for version_data in chart_data_all_versions:
@@ -81,65 +273,39 @@ def extract_images(url, chart_data_all_versions, version=None):
             break
 
     chart_name = chart_data.get("name", "unknown")
-    source_files_archive = chart_data.get("urls", [""])[0]
-    source_files_archive_path = f"{ARCHIVES_DIR}{source_files_archive}"
-    if not os.path.isfile(source_files_archive_path):
-        # download source files archive just once
-        try:
-            response = requests.get(f"https://eea.github.io/helm-charts/{source_files_archive}", timeout=60)
-            if response.status_code != 200:
-                log.warning("Source files archive not found for chart %s, skipping %s", chart_name, url)
-                return {}, []
-            with open(source_files_archive_path, "wb") as f:
-                f.write(response.content)
-        except requests.RequestException:
-            log.exception("Network error downloading source files archive for chart %s", chart_name)
-            return {}, []
-
-    # extract source files from archive
-    try:
-        archive_file = tarfile.open(f"{ARCHIVES_DIR}{source_files_archive}")
-        archive_file.extractall(EXTRACTION_DIR)
+    chart_key = (chart_name, chart_data.get("version"))
+    if chart_key in _chart_images:
+        chart_data, images = _chart_images[chart_key]
+        return chart_data, list(images)
 
-        # get the main docker image under image: repository:
-        values_file_path = f"{EXTRACTION_DIR}{chart_name}/values.yaml"
-        with open(values_file_path) as values_file:
-            values_dict = yaml.load(values_file.read(), Loader=yaml.FullLoader)
-            app_version = chart_data.get('appVersion', chart_data.get('version', 'version-unknown'))
+    # check if link is EEA helm chart
+    try:
+        response = requests.get(url, timeout=60)
+    except requests.RequestException:
+        log.exception("Network error fetching helm chart %s", url)
+        return {}, []
 
-            image_cfg = values_dict.get("image")
-            if not image_cfg or "repository" not in image_cfg:
-                return {}, []
+    if response.status_code != 200:
+        log.warning("Helm chart not found, skipping %s", url)
+        return {}, []
 
-            images = [f"{image_cfg['repository']}:{app_version}"]
+    try:
+        content = _get_archive(chart_data)
+    except requests.RequestException:
+        log.exception("Network error downloading source files archive for chart %s", chart_name)
+        return {}, []
+    if content is None:
+        log.warning("No valid source files archive for chart %s, skipping %s", chart_name, url)
+        return {}, []
 
-        # get all images found in templates/
-        templates_dir = f"{EXTRACTION_DIR}{chart_name}/templates/"
-        if os.path.isdir(templates_dir):
-            for file_path in glob.glob(f"{templates_dir}*.yaml"):
-                try:
-                    with open(file_path) as f:
-                        for line in f.read().splitlines():
-                            if " image: " in line and "{{" not in line:
-                                images.append(line)
-                except (OSError, IOError):
-                    log.warning("Failed to read template file %s", file_path)
-
-        return chart_data, images
+    try:
+        chart_data, images = _parse_chart_images(content, chart_data)
     except Exception:
         log.exception("Failed to extract images from chart %s", chart_name)
         return {}, []
-    finally:
-        # delete extracted files
-        try:
-            archive_file.close()
-        except Exception:
-            pass
-        try:
-            if os.path.exists(EXTRACTION_DIR):
-                shutil.rmtree(EXTRACTION_DIR)
-        except Exception:
-            pass
+
+    _chart_images[chart_key] = (chart_data, images)
+    return chart_data, list(images)
 
 
 def get_docker_images_rancher2(urls):
@@ -196,6 +362,7 @@ def get_docker_images_rancher2(urls):
             docker_images[url] = {
                 "chart_name": chart_name,
                 "chart_version": chart_version,
+                "deployed_versions": get_chart_versions(chart_name),
                 "latest_version": chart_data_all_versions[0].get("version", "unknown"),
                 "images": {},
             }
@@ -241,18 +408,34 @@ def generate_images_text_rancher2(docker_images, image_checker):
     text = ""
     update_section = False
 
+    # resolve the images of all charts at once, in parallel
+    images_status = image_checker.check_many(
+        name for data in docker_images.values() for name in data.get("images", {})
+    )
+
     for url, data in docker_images.items():
         try:
-            _, msg = image_checker.compare_versions(
-                data.get("chart_name", "unknown"), [data.get("latest_version", "unknown")], data.get("chart_version", "unknown")
+            msg = render_textile(
+                image_checker.compare_versions(
+                    data.get("chart_name", "unknown"), [data.get("latest_version", "unknown")], data.get("chart_version", "unknown")
+                )
             )
             text += f"h4. Helm chart \"eea/{data['chart_name']}\":{url} | {msg}\n\n"
+            deployed = [
+                (version, cluster)
+                for cluster, versions in data.get("deployed_versions", {}).items()
+                for version in versions
+            ]
+            if len({version for version, _ in deployed}) > 1:
+                text += "*Deployed versions*: " + ", ".join(
+                    f"{version} on {cluster or 'unknown cluster'}" for version, cluster in deployed
+                ) + "\n\n"
             images = data.get("images", {})
             for name in sorted(images):
                 text += '* *"' + name + '":' + images[name][1] + "*"
                 if images[name][0]:
                     text += ' | "Source code":' + images[name][0]
-                update_needed, update_msg = image_checker.check_image_and_base_status(name)
+                update_needed, update_msg = render_status(images_status[name])
                 update_section |= update_needed
                 text += " | " + update_msg + "\n"
 
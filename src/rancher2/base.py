@@ -2,34 +2,58 @@ import json
 import logging
 import time
 
-from utils import memory_unit_conversion, retry_call
+from rancher2.auth import DATA_PAGE_SUFFIX, RancherClient
+from utils import get_field, memory_unit_conversion
 
 log = logging.getLogger(__name__)
 
 
 class Rancher2Base:
-    def __init__(self, redmineClient, dryrun=False):
+    def __init__(self, redmineClient, dryrun=False, store=None, rancher_client=None):
+        """
+        :param store: rancher2.snapshot.ClusterSnapshot of this run, or
+        rancher2.informer.ClusterStore kept up to date by the daemon mode,
+        the objects it has are read from it instead of being listed
+        :param rancher_client: cluster to list, the one of the RANCHER2_*
+        variables by default
+        """
         self.redmineClient = redmineClient
         self.dryrun = dryrun
+        self.store = store
+        self.rancher_client = rancher_client
 
         if not self.pageTitle:
             raise Exception(
                 "pageTitle is not set, please set pageTitle in the subclass"
             )
 
-        self.content = []
-        self.content.append(f"h1. {self.pageTitle}\n")
-        self.content.append("{{>toc}}\n\n")
-        self.content.append(
+        self.content = self._header(self.pageTitle)
+        # JSON serializable data of the page, for the lookups
+        # that would otherwise parse the textile ( see write_page )
+        self.data = None
+        # pages written, or found unchanged, by write_page, for the heartbeat
+        self.pages_written = []
+
+    def _header(self, page_title):
+        return [
+            f"h1. {page_title}\n",
+            "{{>toc}}\n\n",
             "Automatically discovered on "
             + time.strftime("%d %B %Y")
-            + f". {self.redmineClient.marker}"
-        )
+            + f". {self.redmineClient.marker}",
+        ]
+
+    def _get_rancher_client(self):
+        if not self.rancher_client:
+            self.rancher_client = RancherClient()
+        return self.rancher_client
 
     def _get_nodes(self, rancher_client):
+        if self.store and self.store.nodes() is not None:
+            return self.store.nodes()
+
         try:
-            nodes_response = retry_call(rancher_client.v1.list_node, _request_timeout=30)
-            nodes_list = nodes_response.to_dict()["items"]
+            nodes_list = rancher_client.list_items(rancher_client.v1.list_node)
             log.info("Found %d nodes", len(nodes_list))
             return nodes_list
         except Exception:
@@ -44,18 +68,15 @@ class Rancher2Base:
         @return: The capacity, requested memory and memory limit
 
         """
-        node_name = node.get("metadata", {}).get("name", "unknown")
+        node_name = get_field(node, "metadata", "name", default="unknown")
         capacity = round(
-            memory_unit_conversion(
-                node.get("status", {}).get("capacity", {}).get("memory")
-            ),
+            memory_unit_conversion(get_field(node, "status", "capacity", "memory")),
             2,
         )
 
+        annotations = get_field(node, "metadata", "annotations", default={})
         try:
-            pod_requests_raw = node.get("metadata", {}).get("annotations", {}).get(
-                "management.cattle.io/pod-requests", "{}"
-            )
+            pod_requests_raw = annotations.get("management.cattle.io/pod-requests", "{}")
             pod_requests = json.loads(pod_requests_raw)
             requested = round(memory_unit_conversion(pod_requests.get("memory")), 2)
         except (json.JSONDecodeError, TypeError, KeyError) as e:
@@ -63,9 +84,7 @@ class Rancher2Base:
             requested = 0
 
         try:
-            pod_limits_raw = node.get("metadata", {}).get("annotations", {}).get(
-                "management.cattle.io/pod-limits", "{}"
-            )
+            pod_limits_raw = annotations.get("management.cattle.io/pod-limits", "{}")
             pod_limits = json.loads(pod_limits_raw)
             limit = round(memory_unit_conversion(pod_limits.get("memory")), 2)
         except (json.JSONDecodeError, TypeError, KeyError) as e:
@@ -74,17 +93,34 @@ class Rancher2Base:
 
         return capacity, requested, limit
 
-    def write_page(self):
-        content = "\n".join(self.content)
+    def _write(self, page_title, lines):
+        content = "\n".join(lines)
         if self.dryrun:
-            log.info("Would write page %s", self.pageTitle)
+            log.info("Would write page %s", page_title)
             print(content)
         else:
             try:
-                self.redmineClient.write_page(self.pageTitle, content)
-                log.info("Wrote page %s", self.pageTitle)
+                if self.redmineClient.write_page(page_title, content):
+                    self.pages_written.append(page_title)
+                    return True
             except Exception:
-                log.exception("Failed to write page %s", self.pageTitle)
+                log.exception("Failed to write page %s", page_title)
+        return False
+
+    def _write_data(self, page_title, data):
+        """
+        Writes data as JSON to the data page of page_title, read back with
+        RedmineClient.get_page_data
+        """
+        title = page_title + DATA_PAGE_SUFFIX
+        # no "<" in the <pre> block, it would end at a "</pre>" string
+        payload = json.dumps(data, separators=(",", ":")).replace("<", "\\u003c")
+        return self._write(title, self._header(title) + [f"<pre>{payload}</pre>"])
+
+    def write_page(self):
+        self._write(self.pageTitle, self.content)
+        if self.data is not None:
+            self._write_data(self.pageTitle, self.data)
 
     def set_content(self):
         raise NotImplementedError
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from kubernetes import watch
+from kubernetes.client.exceptions import ApiException
+
+from rancher2.auth import iter_list_pages
+from rancher2.records import compact_node, compact_pod, node_key, pod_key
+
+log = logging.getLogger(__name__)
+
+
+class ClusterStore:
+    """
+    In memory copy of the cluster nodes and pods, kept up to date by the
+    informers. Only the compact records are stored.
+
+    generation is incremented whenever a record the pages use changes.
+    """
+
+    def __init__(self):
+        self.records = {"nodes": {}, "pods": {}}
+        self.synced = {"nodes": threading.Event(), "pods": threading.Event()}
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def _changed(self):
+        self.generation += 1
+        self.condition.notify_all()
+
+    def replace(self, kind, records):
+        """Replaces all the records of a kind, after a full LIST"""
+        with self.condition:
+            if records != self.records[kind]:
+                self.records[kind] = records
+                self._changed()
+        self.synced[kind].set()
+
+    def put(self, kind, key, record):
+        with self.condition:
+            if self.records[kind].get(key) != record:
+                self.records[kind][key] = record
+                self._changed()
+
+    def delete(self, kind, key):
+        with self.condition:
+            if self.records[kind].pop(key, None) is not None:
+                self._changed()
+
+    def wait_synced(self, timeout=None):
+        return all(event.wait(timeout) for event in self.synced.values())
+
+    def wait_for_change(self, generation, timeout):
+        """
+        Waits until the store differs from the given generation, returns the
+        current generation
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+    def nodes(self):
+        """Nodes sorted by name, as returned by list_node"""
+        with self.condition:
+            return [self.records["nodes"][key] for key in sorted(self.records["nodes"])]
+
+    def pods_by_node(self):
+        """Pods grouped by node name, as returned by Rancher2Pods._get_pods"""
+        pods_dict = defaultdict(list)
+        with self.condition:
+            for key in sorted(self.records["pods"]):
+                pod = self.records["pods"][key]
+                node_name = pod["spec"]["node_name"]
+                if node_name:
+                    pods_dict[node_name].append(pod)
+        return pods_dict
+
+
+class RawWatch(watch.Watch):
+    """Watch yielding the objects as plain (camelCase) dicts, no models"""
+
+    def get_return_type(self, func):
+        return None
+
+
+class Informer(threading.Thread):
+    """
+    Keeps one kind of the ClusterStore up to date: a full LIST, then a WATCH
+    resumed from the last seen resourceVersion. Bookmarks keep the
+    resourceVersion fresh, the LIST is repeated only when it expired (410).
+    """
+
+    def __init__(
+        self,
+        list_func,
+        kind,
+        compact,
+        key,
+        store,
+        page_size=500,
+        timeout_seconds=300,
+        retry_delay=30,
+    ):
+        super().__init__(name=f"informer-{kind}", daemon=True)
+        self.list_func = list_func
+        self.kind = kind
+        self.compact = compact
+        self.key = key
+        self.store = store
+        self.page_size = page_size
+        self.timeout_seconds = timeout_seconds
+        self.retry_delay = retry_delay
+        self.stopped = threading.Event()
+        self.watcher = None
+
+    def stop(self):
+        self.stopped.set()
+        if self.watcher:
+            self.watcher.stop()
+
+    def _list(self):
+        records = {}
+        resource_version = None
+        for page in iter_list_pages(self.list_func, page_size=self.page_size):
+            for item in page.get("items", []):
+                record = self.compact(item)
+                records[self.key(record)] = record
+            # all the pages of a LIST share the same resourceVersion
+            resource_version = page["metadata"]["resourceVersion"]
+        self.store.replace(self.kind, records)
+        log.info("Listed %d %s", len(records), self.kind)
+
+        return resource_version
+
+    def _watch(self, resource_version):
+        """
+        Applies the watch events to the store, returns the resourceVersion
+        to resume from or None if a new LIST is needed
+        """
+        self.watcher = RawWatch()
+        for event in self.watcher.stream(
+            self.list_func,
+            resource_version=resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=self.timeout_seconds,
+            _request_timeout=self.timeout_seconds + 30,
+        ):
+            event_type = event["type"]
+            obj = event["raw_object"]
+            if event_type == "ERROR":
+                if obj.get("code") == 410:
+                    log.info("Watch of %s expired, listing again", self.kind)
+                    return None
+                raise ApiException(status=obj.get("code"), reason=obj.get("message"))
+
+            resource_version = obj["metadata"]["resourceVersion"]
+            if event_type == "BOOKMARK":
+                continue
+
+            record = self.compact(obj)
+            if event_type == "DELETED":
+                self.store.delete(self.kind, self.key(record))
+            else:
+                self.store.put(self.kind, self.key(record), record)
+
+            if self.stopped.is_set():
+                break
+
+        return resource_version
+
+    def run(self):
+        resource_version = None
+        while not self.stopped.is_set():
+            try:
+                if resource_version is None:
+                    resource_version = self._list()
+                resource_version = self._watch(resource_version)
+            except ApiException as exc:
+                if exc.status == 410:
+                    resource_version = None
+                    continue
+                log.exception("Failed to watch %s, retrying", self.kind)
+                time.sleep(self.retry_delay)
+            except Exception:
+                log.exception("Failed to watch %s, retrying", self.kind)
+                time.sleep(self.retry_delay)
+
+
+def start_informers(rancher_client, store):
+    informers = [
+        Informer(rancher_client.v1.list_node, "nodes", compact_node, node_key, store),
+        Informer(
+            rancher_client.v1.list_pod_for_all_namespaces,
+            "pods",
+            compact_pod,
+            pod_key,
+            store,
+            page_size=rancher_client.page_size,
+        ),
+    ]
+    for informer in informers:
+        informer.start()
+    return informers
@@ -1,43 +1,164 @@
 import base64
-import gzip
-import io
+import codecs
 import json
 import logging
+import multiprocessing
 import os
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 from dotenv import load_dotenv
 
-from rancher2.auth import RancherClient, RedmineClient
+from disk_cache import DiskCache
+from rancher2.auth import RedmineClient
 from rancher2.base import Rancher2Base
-from utils import retry_call
+from rancher2.merge import Rancher2Merge
+from utils import api_timestamp, get_field
 
 load_dotenv()
 
 log = logging.getLogger(__name__)
 
+HELM_RELEASES_SELECTOR = "owner=helm,status=deployed"
+
+CHART_METADATA_KEY = '"chart":{"metadata":'
+GZIP_MAGIC = b"\x1f\x8b"
+# base64 characters of a release decoded at once, a multiple of 4
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# process pool of decode_chart_metadata, see start_decode_pool
+_decode_pool = None
+
+
+def _iter_release_json(encoded_data):
+    """
+    Yields the JSON text of a helm release secret chunk by chunk: base64
+    decoded and gunzipped incrementally, so that the caller can stop early
+    """
+    release = base64.b64decode(encoded_data)
+    gzipped = base64.b64decode(release[:4])[:2] == GZIP_MAGIC
+    decompressor = zlib.decompressobj(wbits=31)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+    for start in range(0, len(release), DECODE_CHUNK_SIZE):
+        data = base64.b64decode(release[start : start + DECODE_CHUNK_SIZE])
+        if gzipped:
+            data = decompressor.decompress(data)
+        yield text_decoder.decode(data)
+
+
+def decode_chart_metadata(encoded_data):
+    """
+    Returns the chart metadata of a helm release secret, None if it can not
+    be decoded. Module level so that it can run in a process pool.
+
+    The release JSON starts with the name, the info and the chart metadata,
+    the rendered manifest, the templates and the values come after: the
+    decoding stops as soon as the chart metadata is complete.
+    """
+    try:
+        decoder = json.JSONDecoder()
+        text = ""
+        start = -1
+        for chunk in _iter_release_json(encoded_data):
+            search_from = max(0, len(text) - len(CHART_METADATA_KEY))
+            text += chunk
+            if start < 0:
+                start = text.find(CHART_METADATA_KEY, search_from)
+                if start < 0:
+                    continue
+            try:
+                metadata, _ = decoder.raw_decode(text, start + len(CHART_METADATA_KEY))
+                return metadata or {}
+            except json.JSONDecodeError:
+                # the metadata continues in the next chunk
+                continue
+
+        # unexpected layout, decode the whole release
+        chart_data = json.loads(text)["chart"]
+        return chart_data.get("metadata") or {}
+    except Exception:
+        log.exception("Failed to decode chart data from secret")
+        return None
+
+
+def start_decode_pool():
+    """
+    Starts the RANCHER2_DECODE_WORKERS processes decoding the helm releases
+    of the apps pages. To be called once from the main thread, before any
+    other thread is started: the workers are forked right away, as forking
+    a multithreaded process can deadlock and spawned workers would import
+    the entry script again. Without it the releases are decoded in-process.
+    """
+    global _decode_pool
+    workers = int(os.getenv("RANCHER2_DECODE_WORKERS", os.cpu_count() or 1))
+    if _decode_pool is not None or workers <= 1:
+        return
+    _decode_pool = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork")
+    )
+    # the fork context starts all the workers with the first task
+    _decode_pool.submit(int).result()
+    log.info("Started %d helm release decoding processes", workers)
+
 
 class Rancher2Apps(Rancher2Base):
-    def __init__(self, dryrun=False):
+    def __init__(self, dryrun=False, store=None, rancher_client=None):
         redmineClient = RedmineClient()
-        self.pageTitle = f"{redmineClient.apps_page}_{redmineClient.cluster_name}"
-        super().__init__(redmineClient, dryrun)
+        cluster_name = rancher_client.cluster_name if rancher_client else redmineClient.cluster_name
+        self.pageTitle = f"{redmineClient.apps_page}_{cluster_name}"
+        # chart metadata of the releases decoded on previous runs
+        self.charts_cache = DiskCache(
+            os.getenv("RANCHER2_CHARTS_CACHE_PATH", "./cache/charts.sqlite"),
+            ttls={"chart": int(os.getenv("RANCHER2_CHARTS_CACHE_TTL", 30 * 24 * 3600))},
+        )
+        super().__init__(redmineClient, dryrun, store, rancher_client)
 
-    def _decode_chart_data(self, encoded_data):
-        try:
-            decoded_data = base64.b64decode(encoded_data)
-            decoded_data = base64.b64decode(decoded_data)
-            with gzip.GzipFile(fileobj=io.BytesIO(decoded_data), mode="rb") as f:
-                decompressed_data = f.read()
-            chart_data = json.loads(decompressed_data)["chart"]
-            return chart_data
-        except Exception:
-            log.exception("Failed to decode chart data from secret")
-            return {}
+    def _decode_charts(self, apps):
+        """
+        Decodes the chart metadata of all the releases, in the process pool
+        of start_decode_pool as the base64 + gzip + JSON decoding is CPU
+        bound, it is safe to call from any thread. A release secret is
+        decoded once per resourceVersion, the result is cached.
+
+        @return: list of chart metadata dicts, in the order of apps
+        """
+        charts = [None] * len(apps)
+        to_decode = {}
+        for index, app in enumerate(apps):
+            release = get_field(app, "data", "release", default="")
+            if not release:
+                continue
+            key = (
+                f"{get_field(app, 'metadata', 'uid')}:"
+                f"{get_field(app, 'metadata', 'resource_version')}"
+            )
+            charts[index] = self.charts_cache.get("chart", key)
+            if charts[index] is None:
+                to_decode[index] = (key, release)
+        log.info("Decoding %d of %d helm releases", len(to_decode), len(apps))
+
+        releases = [release for _, release in to_decode.values()]
+        if _decode_pool is None or len(releases) < 2:
+            decoded = [decode_chart_metadata(release) for release in releases]
+        else:
+            decoded = list(
+                _decode_pool.map(decode_chart_metadata, releases, chunksize=8)
+            )
+
+        for (index, (key, _)), metadata in zip(to_decode.items(), decoded):
+            charts[index] = metadata
+            if metadata is not None:
+                self.charts_cache.set("chart", key, metadata)
+        return charts
 
     def _get_namespaces(self, rancher_client):
+        if self.store and self.store.namespaces() is not None:
+            return self.store.namespaces()
+
         try:
-            namespaces_response = retry_call(rancher_client.v1.list_namespace, _request_timeout=30)
-            namespaces_list = namespaces_response.to_dict().get("items", [])
+            namespaces_list = rancher_client.list_items(rancher_client.v1.list_namespace)
             log.info("Found %d namespaces", len(namespaces_list))
             return namespaces_list
         except Exception:
@@ -46,20 +167,45 @@ class Rancher2Apps(Rancher2Base):
 
     def _get_apps(self, rancher_client, namespace_id):
         try:
-            apps_response = retry_call(
+            return rancher_client.list_items(
                 rancher_client.v1.list_namespaced_secret,
                 namespace_id,
-                label_selector="owner=helm,status=deployed",
-                _request_timeout=30,
+                label_selector=HELM_RELEASES_SELECTOR,
             )
-            apps_list = apps_response.to_dict().get("items", [])
-            return apps_list
         except Exception:
             log.exception("Failed to list apps for namespace %s", namespace_id)
             return []
 
+    def _get_apps_by_namespace(self, rancher_client, namespaces):
+        """
+        Lists the deployed helm releases of all namespaces in one paginated
+        call and groups them by namespace. Falls back to one call per
+        namespace if secrets can not be listed cluster wide.
+        """
+        if self.store and self.store.apps_by_namespace() is not None:
+            return self.store.apps_by_namespace()
+
+        apps_by_namespace = defaultdict(list)
+        try:
+            apps = rancher_client.list_items(
+                rancher_client.v1.list_secret_for_all_namespaces,
+                label_selector=HELM_RELEASES_SELECTOR,
+            )
+            for app in apps:
+                apps_by_namespace[get_field(app, "metadata", "namespace")].append(app)
+            log.info("Found %d apps across all namespaces", len(apps))
+            return apps_by_namespace
+        except Exception:
+            log.exception("Failed to list apps of all namespaces, listing them per namespace")
+
+        for namespace in namespaces:
+            namespace_id = get_field(namespace, "metadata", "name", default="")
+            if namespace_id:
+                apps_by_namespace[namespace_id] = self._get_apps(rancher_client, namespace_id)
+        return apps_by_namespace
+
     def set_content(self):
-        rancher_client = RancherClient()
+        rancher_client = self._get_rancher_client()
         server_link = f"{rancher_client.base_url}dashboard"
         cluster_link = f"{server_link}/c/{rancher_client.cluster_id}/explorer"
 
@@ -69,13 +215,18 @@ class Rancher2Apps(Rancher2Base):
         )
 
         namespaces = self._get_namespaces(rancher_client)
+        apps_by_namespace = self._get_apps_by_namespace(rancher_client, namespaces)
+
+        all_apps = [app for apps in apps_by_namespace.values() for app in apps]
+        charts = dict(zip(map(id, all_apps), self._decode_charts(all_apps)))
+
         for namespace in namespaces:
             try:
-                namespace_id = namespace.get("metadata", {}).get("name", "")
+                namespace_id = get_field(namespace, "metadata", "name", default="")
                 if not namespace_id:
                     continue
 
-                apps = self._get_apps(rancher_client, namespace_id)
+                apps = apps_by_namespace.get(namespace_id)
                 if not apps:
                     continue
 
@@ -86,8 +237,10 @@ class Rancher2Apps(Rancher2Base):
                 self.content.append(
                     f"\nh4. _Namespace: \"{namespace_id}\":{namespace_link}_\n"
                 )
-                namespace_phase = namespace.get("status", {}).get("phase", "Unknown")
-                namespace_created = namespace.get("metadata", {}).get("creation_timestamp", "-")
+                namespace_phase = get_field(namespace, "status", "phase", default="Unknown")
+                namespace_created = api_timestamp(
+                    get_field(namespace, "metadata", "creation_timestamp", default="-")
+                )
                 self.content.append(
                     f"*State*: {namespace_phase} &nbsp; &nbsp; "
                     f"*Created*: {namespace_created}\n"
@@ -98,8 +251,8 @@ class Rancher2Apps(Rancher2Base):
                     "|_{min-width:14em}. Name |_. State |_. Chart Name |_. Chart Version "
                     "|_. Created date |_. Description |"
                 )
-                description = namespace.get("metadata", {}).get("annotations", {}).get(
-                    "field.cattle.io/description", ""
+                description = get_field(
+                    namespace, "metadata", "annotations", "field.cattle.io/description", default=""
                 )
                 app_base_link = (
                     f"{rancher_client.base_url}dashboard/c/{rancher_client.cluster_id}"
@@ -107,26 +260,30 @@ class Rancher2Apps(Rancher2Base):
                 )
                 for app in apps:
                     try:
-                        app_data = app.get("data", {})
-                        release_data = app_data.get("release", "")
+                        release_data = get_field(app, "data", "release", default="")
                         if not release_data:
                             log.warning("App in namespace %s has no release data", namespace_id)
                             continue
 
-                        chart_data = self._decode_chart_data(release_data)
-                        if not chart_data:
-                            continue
+                        app_name = get_field(app, "metadata", "labels", "name", default="unknown")
+                        chart_metadata = charts.get(id(app))
+                        if chart_metadata is None:
+                            log.warning(
+                                "Failed to decode the release of app %s in namespace %s",
+                                app_name, namespace_id,
+                            )
+                            chart_metadata = {}
 
-                        app_name = app.get("metadata", {}).get("labels", {}).get("name", "unknown")
                         app_link = f"{app_base_link}/{app_name}"
                         if namespace_id.endswith("-system"):
                             app_name = f">. _{app_name}_"
 
-                        app_status = app.get("metadata", {}).get("labels", {}).get("status", "unknown")
-                        chart_metadata = chart_data.get("metadata", {})
+                        app_status = get_field(app, "metadata", "labels", "status", default="unknown")
                         chart_name = chart_metadata.get("name", "unknown")
                         chart_version = chart_metadata.get("version", "unknown")
-                        app_created = app.get("metadata", {}).get("creation_timestamp", "-")
+                        app_created = api_timestamp(
+                            get_field(app, "metadata", "creation_timestamp", default="-")
+                        )
 
                         self.content.append(
                             f"|\"{app_name}\":{app_link} | {app_status} "
@@ -134,44 +291,30 @@ class Rancher2Apps(Rancher2Base):
                             f"| {app_created} | {description} |"
                         )
                     except Exception:
-                        app_name = app.get("metadata", {}).get("name", "unknown")
+                        app_name = get_field(app, "metadata", "name", default="unknown")
                         log.exception("Failed to process app %s in namespace %s", app_name, namespace_id)
             except Exception:
-                namespace_id = namespace.get("metadata", {}).get("name", "unknown")
+                namespace_id = get_field(namespace, "metadata", "name", default="unknown")
                 log.exception("Failed to process namespace %s", namespace_id)
 
 
-class Rancher2MergeApps(Rancher2Base):
-    def __init__(self, dryrun=False):
+class Rancher2MergeApps(Rancher2Merge):
+    def __init__(self, dryrun=False, drafts=None):
         redmineClient = RedmineClient()
         self.pageTitle = redmineClient.apps_page
-        self.clusters_to_merge = os.getenv("RANCHER2_CLUSTERS_TO_MERGE", "").split("|")
-        super().__init__(redmineClient, dryrun)
-
-    def set_content(self):
-        merged_content = {}
-        for cluster_data in self.clusters_to_merge:
-            try:
-                rancher_url, rancher_server_name, cluster = cluster_data.split(",")
-            except ValueError:
-                log.error("Invalid RANCHER2_CLUSTERS_TO_MERGE entry: %s", cluster_data)
-                continue
-
-            if rancher_server_name not in merged_content:
-                merged_content[rancher_server_name] = {
-                    "title": f'h2. "{rancher_server_name}":{rancher_url}dashboard',
-                    "content": [],
-                }
-
-            try:
-                page_key = f"{self.pageTitle}_{cluster}"
-                text = self.redmineClient.get_page_text(page_key)
-                if not text:
-                    log.warning("No text found for page %s", page_key)
-                merged_content[rancher_server_name]["content"].extend(text.splitlines())
-            except Exception:
-                log.exception("Failed to get page text for cluster %s", cluster)
+        super().__init__(redmineClient, dryrun, drafts)
 
-        for server_content in merged_content.values():
-            self.content.append(f"\n{server_content['title']}\n")
-            self.content.extend(server_content["content"])
+    def _prepare(self, drafts):
+        # the apps of all the clusters, from the tables of the drafts, for
+        # the chart version lookup of addimageinfo.py
+        self.data = {"apps": []}
+        for draft in drafts:
+            for line in draft.lines:
+                columns = line.split("|")
+                if len(columns) > 4 and not columns[3].strip().startswith("_."):
+                    self.data["apps"].append({
+                        "chart": columns[3].strip(),
+                        "version": columns[4].strip(),
+                        "server": draft.server,
+                        "cluster": draft.cluster,
+                    })
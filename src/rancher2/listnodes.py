@@ -1,11 +1,12 @@
 import json
 import logging
-import os
 
 from dotenv import load_dotenv
 
-from rancher2.auth import RancherClient, RedmineClient
+from rancher2.auth import RedmineClient
 from rancher2.base import Rancher2Base
+from rancher2.merge import Rancher2Merge
+from utils import api_timestamp, get_field
 
 load_dotenv()
 
@@ -13,13 +14,14 @@ log = logging.getLogger(__name__)
 
 
 class Rancher2Nodes(Rancher2Base):
-    def __init__(self, dryrun=False):
+    def __init__(self, dryrun=False, store=None, rancher_client=None):
         redmineClient = RedmineClient()
-        self.pageTitle = f"{redmineClient.nodes_page}_{redmineClient.cluster_name}"
-        super().__init__(redmineClient, dryrun)
+        cluster_name = rancher_client.cluster_name if rancher_client else redmineClient.cluster_name
+        self.pageTitle = f"{redmineClient.nodes_page}_{cluster_name}"
+        super().__init__(redmineClient, dryrun, store, rancher_client)
 
     def set_content(self):
-        rancher_client = RancherClient()
+        rancher_client = self._get_rancher_client()
         server_link = f"{rancher_client.base_url}dashboard"
         cluster_link = f"{server_link}/c/{rancher_client.cluster_id}/explorer"
         cluster_capacity = 0
@@ -37,7 +39,7 @@ class Rancher2Nodes(Rancher2Base):
         nodes = self._get_nodes(rancher_client)
         for node in nodes:
             try:
-                node_name = node.get("metadata", {}).get("name", "unknown")
+                node_name = get_field(node, "metadata", "name", default="unknown")
                 capacity, requested, limit = self._get_memory_data(node)
                 node_link = f"{cluster_link}/node/{node_name}"
                 check_mk_link = (
@@ -46,27 +48,26 @@ class Rancher2Nodes(Rancher2Base):
                     f"{node_name.split('.')[0]}%26site%3Domdeea"
                 )
                 taints = ""
-                if node.get("spec", {}).get("taints"):
-                    taints = [taint["key"] for taint in node["spec"]["taints"]]
+                if get_field(node, "spec", "taints"):
+                    taints = [taint["key"] for taint in get_field(node, "spec", "taints")]
                     taints = "\n".join(taints)
 
+                annotations = get_field(node, "metadata", "annotations", default={})
                 try:
-                    pods_raw = node.get("metadata", {}).get("annotations", {}).get(
-                        "management.cattle.io/pod-requests", "{}"
-                    )
+                    pods_raw = annotations.get("management.cattle.io/pod-requests", "{}")
                     pods_used = json.loads(pods_raw).get("pods", "-")
                 except (json.JSONDecodeError, TypeError, KeyError) as e:
                     log.warning("Node %s: failed to parse pod-requests for pod count: %s", node_name, e)
                     pods_used = "-"
 
-                node_ip = node.get("metadata", {}).get("annotations", {}).get(
-                    "alpha.kubernetes.io/provided-node-ip", "-"
+                node_ip = annotations.get("alpha.kubernetes.io/provided-node-ip", "-")
+                node_version = get_field(
+                    node, "status", "node_info", "container_runtime_version", default="-"
                 )
-                node_version = node.get("status", {}).get("node_info", {}).get(
-                    "container_runtime_version", "-"
+                node_os = get_field(node, "status", "node_info", "os_image", default="-")
+                node_created = api_timestamp(
+                    get_field(node, "metadata", "creation_timestamp", default="-")
                 )
-                node_os = node.get("status", {}).get("node_info", {}).get("os_image", "-")
-                node_created = node.get("metadata", {}).get("creation_timestamp", "-")
 
                 cluster_content.append(
                     f"| \"{node_name}\":{node_link} "
@@ -84,7 +85,7 @@ class Rancher2Nodes(Rancher2Base):
                 cluster_requested += requested
                 cluster_limit += limit
             except Exception:
-                node_name = node.get("metadata", {}).get("name", "unknown")
+                node_name = get_field(node, "metadata", "name", default="unknown")
                 log.exception("Failed to process node %s", node_name)
 
         # add the cluster information
@@ -105,37 +106,8 @@ class Rancher2Nodes(Rancher2Base):
         self.content.extend(cluster_content)
 
 
-class Rancher2MergeNodes(Rancher2Base):
-    def __init__(self, dryrun=False):
+class Rancher2MergeNodes(Rancher2Merge):
+    def __init__(self, dryrun=False, drafts=None):
         redmineClient = RedmineClient()
         self.pageTitle = redmineClient.nodes_page
-        self.clusters_to_merge = os.getenv("RANCHER2_CLUSTERS_TO_MERGE", "").split("|")
-        super().__init__(redmineClient, dryrun)
-
-    def set_content(self):
-        merged_content = {}
-        for cluster_data in self.clusters_to_merge:
-            try:
-                rancher_url, rancher_server_name, cluster = cluster_data.split(",")
-            except ValueError:
-                log.error("Invalid RANCHER2_CLUSTERS_TO_MERGE entry: %s", cluster_data)
-                continue
-
-            if rancher_server_name not in merged_content:
-                merged_content[rancher_server_name] = {
-                    "title": f'h2. "{rancher_server_name}":{rancher_url}dashboard',
-                    "content": [],
-                }
-
-            try:
-                page_key = f"{self.pageTitle}_{cluster}"
-                text = self.redmineClient.get_page_text(page_key)
-                if not text:
-                    log.warning("No text found for page %s", page_key)
-                merged_content[rancher_server_name]["content"].extend(text.splitlines())
-            except Exception:
-                log.exception("Failed to get page text for cluster %s", cluster)
-
-        for server_content in merged_content.values():
-            self.content.append(f"\n{server_content['title']}\n")
-            self.content.extend(server_content["content"])
+        super().__init__(redmineClient, dryrun, drafts)
@@ -1,25 +1,58 @@
+import hashlib
 import json
 import logging
 import os
+import re
 from collections import defaultdict
+from datetime import datetime
 
 from dotenv import load_dotenv
 
 from image_checker import ImageChecker
-from rancher2.auth import RancherClient, RedmineClient
+from rancher2.auth import RedmineClient
 from rancher2.base import Rancher2Base
-from utils import memory_unit_conversion, retry_call
+from rancher2.merge import Rancher2Merge
+from textile import render_textile
+from utils import api_timestamp, get_field, memory_unit_conversion, wiki_title
 
 load_dotenv()
 
 log = logging.getLogger(__name__)
 
+# upper bounds of the restart count buckets, see _restarts_bucket
+RESTART_BUCKETS = (0, 5, 20, 100)
+
+# line of the pods page linking to the pods of a node, in shard mode
+SHARD_LINE = re.compile(
+    r"^\*Pods\*: \[\[(?P<title>[^|\]]+)\|[^\]]*\]\] \(version (?P<version>[0-9a-f]+)\)$"
+)
+SHARD_DRAFT_SUFFIX = "_draft"
+
 
 class Rancher2Pods(Rancher2Base):
-    def __init__(self, dryrun=False):
+    def __init__(self, dryrun=False, store=None, rancher_client=None):
         redmineClient = RedmineClient()
-        self.pageTitle = f"{redmineClient.pods_page}_{redmineClient.cluster_name}"
-        super().__init__(redmineClient, dryrun)
+        cluster_name = rancher_client.cluster_name if rancher_client else redmineClient.cluster_name
+        self.pageTitle = f"{redmineClient.pods_page}_{cluster_name}"
+        # how the restarts and start time columns, which change on almost
+        # every run, are rendered: inline (as is), buckets (rounded) or page
+        # (moved to the statusPageTitle page)
+        self.volatile_columns = os.getenv("RANCHER2_PODS_VOLATILE_COLUMNS", "inline")
+        if self.volatile_columns not in ("inline", "buckets", "page"):
+            log.warning(
+                "Unknown RANCHER2_PODS_VOLATILE_COLUMNS %s, using inline",
+                self.volatile_columns,
+            )
+            self.volatile_columns = "inline"
+        self.statusPageTitle = f"{self.pageTitle}_status"
+        self.status_content = []
+        # write the pods of each node to a page of its own, the pods page
+        # only links to them
+        self.shard_by_node = (
+            os.getenv("RANCHER2_PODS_SHARD_BY_NODE", "").lower() in ("yes", "true")
+        )
+        self.shards = {}
+        super().__init__(redmineClient, dryrun, store, rancher_client)
 
     def _get_container_memory_data(self, container, resources_dict):
         resources = resources_dict.get(container["name"], {})
@@ -42,13 +75,34 @@ class Rancher2Pods(Rancher2Base):
 
         return requested, limit
 
+    @staticmethod
+    def _restarts_bucket(restart_count):
+        lower = 0
+        for bound in RESTART_BUCKETS:
+            if restart_count <= bound:
+                return str(bound) if bound == lower else f"{lower}-{bound}"
+            lower = bound + 1
+        return f"{lower}+"
+
+    def _volatile_cells(self, restart_count, start_time):
+        """The restarts and start time cells of the pods table"""
+        if self.volatile_columns == "buckets":
+            restart_count = self._restarts_bucket(restart_count)
+            # the day is enough to tell a recently restarted pod, the start
+            # time is a datetime ( see utils.api_timestamp ) or "-"
+            if isinstance(start_time, datetime):
+                start_time = start_time.strftime("%Y-%m-%d")
+        return f"|>. {restart_count} ", f"| {start_time} "
+
     def _get_pods(self, rancher_client):
+        if self.store and self.store.pods_by_node() is not None:
+            return self.store.pods_by_node()
+
         pods_dict = defaultdict(list)
         try:
-            pods_response = retry_call(rancher_client.v1.list_pod_for_all_namespaces, _request_timeout=30)
-            items = pods_response.to_dict().get("items", [])
-            log.info("Found %d pods across all namespaces", len(items))
-            for pod in items:
+            count = 0
+            for pod in rancher_client.iter_pods():
+                count += 1
                 try:
                     node_name = pod.get("spec", {}).get("node_name", "")
                     if node_name:
@@ -56,21 +110,44 @@ class Rancher2Pods(Rancher2Base):
                 except Exception:
                     pod_name = pod.get("metadata", {}).get("name", "unknown")
                     log.exception("Failed to process pod %s", pod_name)
+            log.info("Found %d pods across all namespaces", count)
             return pods_dict
         except Exception:
             log.exception("Failed to list pods from Rancher API")
             return pods_dict
 
+    def _add_shard(self, title, shard_content):
+        """
+        Keeps the pods table of a node for its own draft page, returns the
+        line of the pods page linking to it. The version lets the merge skip
+        the shards that did not change.
+        """
+        self.shards[title + SHARD_DRAFT_SUFFIX] = shard_content
+        version = hashlib.sha256("\n".join(shard_content).encode()).hexdigest()[:12]
+        return (
+            f"\n*Pods*: [[{title}|{len(shard_content) - 1} containers]] "
+            f"(version {version})"
+        )
+
     def _add_pods_data(self, cluster_content, cluster_link, node, pods_dict):
         redmine_error_color = "%{color:red}"
+        restarts_header, start_time_header = "|_. Restarts ", "|_. Start time "
+        if self.volatile_columns == "page":
+            restarts_header = start_time_header = ""
         cluster_content.append(
             "|_{min-width:14em}. Pod |_. State |_. Namespace |_. Kind |_. Chart "
-            "|_. Image |_. Restarts |_. Reservation |_. Limit |_. Start time |_. Upgrade |"
+            f"|_. Image {restarts_header}|_. Reservation |_. Limit "
+            f"{start_time_header}|_. Upgrade |"
         )
 
-        node_name = node.get("metadata", {}).get("name", "unknown")
+        node_name = get_field(node, "metadata", "name", default="unknown")
         pods = pods_dict.get(node_name, [])
         log.info("Node %s: processing %d pods", node_name, len(pods))
+        if self.volatile_columns == "page" and pods:
+            self.status_content.append(f"\nh4. Node: {node_name}\n")
+            self.status_content.append(
+                "|_. Pod |_. Namespace |_. Container |_. Restarts |_. Start time |"
+            )
 
         for pod in pods:
             try:
@@ -110,11 +187,23 @@ class Rancher2Pods(Rancher2Base):
                         container_image = container.get("image", "unknown")
                         restart_count = container.get("restart_count", 0)
 
+                        if self.volatile_columns == "page":
+                            restarts_cell = start_time_cell = ""
+                            self.status_content.append(
+                                f"| {pod_name} | {pod_namespace} "
+                                f"| {container.get('name', 'unknown')} "
+                                f"|>. {restart_count} | {start_time} |"
+                            )
+                        else:
+                            restarts_cell, start_time_cell = self._volatile_cells(
+                                restart_count, start_time
+                            )
+
                         cluster_content.append(
                             f'| "{pod_name}":{pod_link} | {pod_state} '
                             f"| {pod_namespace} | {pod_kind} | {pod_chart} "
-                            f"| {container_image} |>. {restart_count} "
-                            f"|>. {requested} |>. {limit} | {start_time} | TODO |"
+                            f"| {container_image} {restarts_cell}"
+                            f"|>. {requested} |>. {limit} {start_time_cell}| TODO |"
                         )
                     except Exception:
                         log.exception(
@@ -129,7 +218,7 @@ class Rancher2Pods(Rancher2Base):
                 log.exception("Failed to process pod %s/%s", pod_namespace, pod_name)
 
     def set_content(self):
-        rancher_client = RancherClient()
+        rancher_client = self._get_rancher_client()
         server_link = f"{rancher_client.base_url}dashboard"
         cluster_link = f"{server_link}/c/{rancher_client.cluster_id}/explorer"
         cluster_capacity = 0
@@ -142,18 +231,19 @@ class Rancher2Pods(Rancher2Base):
         log.info("Processing %d nodes for pods data", len(nodes))
         for node in nodes:
             try:
-                node_name = node.get("metadata", {}).get("name", "unknown")
+                node_name = get_field(node, "metadata", "name", default="unknown")
                 # add node information
                 node_link = f"{cluster_link}/node/{node_name}"
                 cluster_content.append(
                     f'\nh4. Node: "{node_name}":{node_link}\n'
                 )
                 cluster_content.append(f"*Description*: {node.get('description', '-')}\n")
+                annotations = get_field(node, "metadata", "annotations", default={})
                 cluster_content.append(
-                    f"*Version*: {node.get('status', {}).get('node_info', {}).get('container_runtime_version', '-')} &nbsp; &nbsp; "
-                    f"*IP address*: {node.get('metadata', {}).get('annotations', {}).get('alpha.kubernetes.io/provided-node-ip', '-')} &nbsp; &nbsp; "
-                    f"*OS*: {node.get('status', {}).get('node_info', {}).get('os_image', '-')} &nbsp; &nbsp; "
-                    f"*Created date*: {node.get('metadata', {}).get('creation_timestamp', '-')}\n"
+                    f"*Version*: {get_field(node, 'status', 'node_info', 'container_runtime_version', default='-')} &nbsp; &nbsp; "
+                    f"*IP address*: {annotations.get('alpha.kubernetes.io/provided-node-ip', '-')} &nbsp; &nbsp; "
+                    f"*OS*: {get_field(node, 'status', 'node_info', 'os_image', default='-')} &nbsp; &nbsp; "
+                    f"*Created date*: {api_timestamp(get_field(node, 'metadata', 'creation_timestamp', default='-'))}\n"
                 )
 
                 # add the memory information
@@ -171,7 +261,7 @@ class Rancher2Pods(Rancher2Base):
                 )
 
                 try:
-                    pod_requests_raw = node.get("metadata", {}).get("annotations", {}).get(
+                    pod_requests_raw = annotations.get(
                         "management.cattle.io/pod-requests", "{}"
                     )
                     pods_used = json.loads(pod_requests_raw).get("pods", "-")
@@ -184,13 +274,19 @@ class Rancher2Pods(Rancher2Base):
                 )
 
                 # add pods information
-                self._add_pods_data(cluster_content, cluster_link, node, pods_dict)
+                if self.shard_by_node:
+                    title = wiki_title(self.pageTitle, node_name)
+                    shard_content = []
+                    self._add_pods_data(shard_content, cluster_link, node, pods_dict)
+                    cluster_content.append(self._add_shard(title, shard_content))
+                else:
+                    self._add_pods_data(cluster_content, cluster_link, node, pods_dict)
 
                 cluster_capacity += capacity
                 cluster_requested += requested
                 cluster_limit += limit
             except Exception:
-                node_name = node.get("metadata", {}).get("name", "unknown")
+                node_name = get_field(node, "metadata", "name", default="unknown")
                 log.exception("Failed to process node %s", node_name)
 
         # add the cluster information
@@ -208,56 +304,126 @@ class Rancher2Pods(Rancher2Base):
             f"{round(cluster_limit * 100 / cluster_capacity, 2)}% used or "
             f"{round(cluster_capacity - cluster_limit, 2)} GiB available\n"
         )
+        if self.volatile_columns == "page":
+            self.content.append(
+                f"*Restarts and start times*: [[{self.statusPageTitle}]]\n"
+            )
         self.content.extend(cluster_content)
 
+    def write_page(self):
+        # the shards first, the pods page versions refer to them
+        for title, shard_content in self.shards.items():
+            self._write(title, self._header(title) + shard_content)
+        super().write_page()
+        if self.volatile_columns == "page":
+            self._write(
+                self.statusPageTitle,
+                self._header(self.statusPageTitle) + self.status_content,
+            )
+
 
-class Rancher2MergePods(Rancher2Base):
-    def __init__(self, dryrun=False):
+class Rancher2MergePods(Rancher2Merge):
+    def __init__(self, dryrun=False, image_checker=None, drafts=None):
         redmineClient = RedmineClient()
         self.pageTitle = redmineClient.pods_page
-        self.image_checker = ImageChecker()
-        self.clusters_to_merge = os.getenv("RANCHER2_CLUSTERS_TO_MERGE", "").split("|")
-        super().__init__(redmineClient, dryrun)
-
-    def set_content(self):
-        merged_content = {}
-        for cluster_data in self.clusters_to_merge:
+        self.image_checker = image_checker or ImageChecker()
+        self.images_status = {}
+        # draft page title: image of each TODO row
+        self.draft_images = {}
+        # final shard page title: (draft version, lines), in shard mode
+        self.shards = {}
+        super().__init__(redmineClient, dryrun, drafts)
+
+    def _changed_shards(self, draft):
+        """
+        The (title, version) of the shards linked from a cluster draft,
+        except the ones already merged today from the same version
+        """
+        shards = []
+        for line in draft.lines:
+            match = SHARD_LINE.match(line.strip())
+            if not match:
+                continue
+            title, version = match.group("title"), match.group("version")
+            if self.redmineClient.is_merged_from(title, version):
+                log.info("Shard %s is unchanged, not merging it", title)
+                continue
+            shards.append((title, version))
+        return shards
+
+    def _read_shards(self, shards):
+        # the shards are only rewritten when they change, the cluster draft
+        # linking to them is the fresh one
+        texts = self.redmineClient.get_pages_text(
+            (title + SHARD_DRAFT_SUFFIX for title, _ in shards), check_date=False
+        )
+        for title, version in shards:
+            text = texts[title + SHARD_DRAFT_SUFFIX]
+            if not text:
+                log.warning("No text found for shard %s", title)
+                continue
+            lines = text.splitlines()
+            self.shards[title] = (version, lines, self._row_images(lines))
+
+    @staticmethod
+    def _row_images(lines):
+        """
+        The image of each TODO row of a draft, None for the rows whose image
+        is not known
+        """
+        images = []
+        for line in lines:
+            if "TODO" not in line:
+                continue
             try:
-                rancher_url, rancher_server_name, cluster = cluster_data.split(",")
-            except ValueError:
-                log.error("Invalid RANCHER2_CLUSTERS_TO_MERGE entry: %s", cluster_data)
+                images.append(line.split("|")[6].strip())  # check image column number
+            except IndexError:
+                log.warning("Failed to find image column in line: %s", line[:80])
+                images.append(None)
+        return images
+
+    def _fill(self, lines, images):
+        """Fills the upgrade column of the pods table with the image checks"""
+        content = []
+        images = iter(images)
+        for line in lines:
+            if "TODO" not in line:
+                content.append(line)
                 continue
 
-            if rancher_server_name not in merged_content:
-                merged_content[rancher_server_name] = {
-                    "title": f'h2. "{rancher_server_name}":{rancher_url}dashboard',
-                    "content": [],
-                }
-
-            try:
-                page_key = f"{self.pageTitle}_{cluster}"
-                text = self.redmineClient.get_page_text(page_key)
-                if not text:
-                    log.warning("No text found for page %s", page_key)
-            except Exception:
-                log.exception("Failed to get page text for cluster %s", cluster)
+            result = self.images_status.get(next(images))
+            if result is None:
+                log.error("Failed to check image status for line: %s", line[:80])
+                content.append(line)
                 continue
+            content.append(line.replace("TODO", render_textile(result)))
+        return content
 
-            for line in text.splitlines():
-                if "TODO" not in line:
-                    merged_content[rancher_server_name]["content"].append(line)
-                    continue
+    def _render(self, draft):
+        return self._fill(draft.lines, self.draft_images[draft.page])
 
-                try:
-                    image = line.split("|")[6].strip()  # check image column number
-                    _, update_msg = self.image_checker.check_image_and_base_status(image)
-                    merged_content[rancher_server_name]["content"].append(
-                        line.replace("TODO", update_msg)
-                    )
-                except (IndexError, Exception):
-                    log.exception("Failed to check image status for line: %s", line[:80])
-                    merged_content[rancher_server_name]["content"].append(line)
+    def _prepare(self, drafts):
+        self._read_shards(
+            [shard for draft in drafts for shard in self._changed_shards(draft)]
+        )
+        self.draft_images = {draft.page: self._row_images(draft.lines) for draft in drafts}
+
+        # collect the images of all clusters and check them in one parallel pass
+        images = [image for images in self.draft_images.values() for image in images]
+        for _, _, shard_images in self.shards.values():
+            images.extend(shard_images)
+        images = [image for image in images if image]
+        unique_images = list(dict.fromkeys(images))
+        log.info(
+            "Checking %d distinct images of %d containers", len(unique_images), len(images)
+        )
+        self.images_status = self.image_checker.check_many(unique_images)
+
+        for title, (version, lines, shard_images) in self.shards.items():
+            self.shards[title] = (version, self._fill(lines, shard_images))
 
-        for server_content in merged_content.values():
-            self.content.append(f"\n{server_content['title']}\n")
-            self.content.extend(server_content["content"])
+    def write_page(self):
+        for title, (version, lines) in self.shards.items():
+            if self._write(title, self._header(title) + lines):
+                self.redmineClient.set_merged_from(title, version)
+        super().write_page()
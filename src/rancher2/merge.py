@@ -0,0 +1,147 @@
+import logging
+import os
+import time
+from collections import namedtuple
+
+from rancher2.auth import RedmineClient
+from rancher2.base import Rancher2Base
+
+log = logging.getLogger(__name__)
+
+# page: the draft page title
+Draft = namedtuple("Draft", ["server", "cluster", "page", "lines"])
+
+
+class MergeDrafts:
+    """
+    The cluster drafts of the clusters of RANCHER2_CLUSTERS_TO_MERGE, for
+    all the merged pages, read in one concurrent pass over the shared
+    Redmine session.
+
+    The drafts are only rewritten when they change, a draft is used if the
+    heartbeat page of its cluster says it was written today. The drafts of
+    the clusters without a heartbeat page, listed by an older instance, are
+    used if their date is today.
+    """
+
+    def __init__(self, redmineClient=None, page_titles=None):
+        """
+        :param page_titles: The merged pages, all of them by default
+        """
+        self.redmineClient = redmineClient or RedmineClient()
+        if page_titles is None:
+            page_titles = [
+                self.redmineClient.apps_page,
+                self.redmineClient.nodes_page,
+                self.redmineClient.pods_page,
+            ]
+        self.page_titles = page_titles
+        # rancher server name -> url, in the order of the clusters
+        self.servers = {}
+        # (rancher server name, cluster name)
+        self.clusters = []
+        self.texts = {}
+        # cluster name -> draft pages written today, None if the cluster has
+        # no heartbeat page
+        self.fresh_pages = {}
+
+        for cluster_data in os.getenv("RANCHER2_CLUSTERS_TO_MERGE", "").split("|"):
+            try:
+                rancher_url, rancher_server_name, cluster = cluster_data.split(",")
+            except ValueError:
+                log.error("Invalid RANCHER2_CLUSTERS_TO_MERGE entry: %s", cluster_data)
+                continue
+            self.servers.setdefault(rancher_server_name, rancher_url)
+            self.clusters.append((rancher_server_name, cluster))
+
+    def fetch(self):
+        page_names = [
+            f"{page_title}_{cluster}"
+            for page_title in self.page_titles
+            for _, cluster in self.clusters
+        ]
+        page_names.extend(
+            self.redmineClient.heartbeat_title(cluster) for _, cluster in self.clusters
+        )
+        self.texts = self.redmineClient.get_pages_text(page_names, check_date=False)
+        log.info("Read %d draft pages", len(self.texts))
+
+        today = time.strftime("%d %B %Y")
+        dated_pages = []
+        for _, cluster in self.clusters:
+            heartbeat_text = self.texts.get(self.redmineClient.heartbeat_title(cluster))
+            if not heartbeat_text:
+                self.fresh_pages[cluster] = None
+                dated_pages.extend(
+                    f"{page_title}_{cluster}" for page_title in self.page_titles
+                )
+                continue
+            heartbeat = self.redmineClient.parse_heartbeat(heartbeat_text)
+            self.fresh_pages[cluster] = {
+                page_name for page_name, date in heartbeat.items() if date == today
+            }
+
+        if dated_pages:
+            log.info("Checking the date of %d drafts without heartbeat", len(dated_pages))
+            self.texts.update(self.redmineClient.get_pages_text(dated_pages))
+        return self
+
+    def _text(self, cluster, page_name):
+        """The text of a draft of the cluster, "" if it was not written today"""
+        fresh_pages = self.fresh_pages.get(cluster)
+        if fresh_pages is not None and page_name not in fresh_pages:
+            log.warning("Page %s was not updated today", page_name)
+            return ""
+        return self.texts.get(page_name, "")
+
+    def drafts(self, page_title):
+        """The Drafts of the clusters for a page"""
+        drafts = []
+        for rancher_server_name, cluster in self.clusters:
+            page_key = f"{page_title}_{cluster}"
+            text = self._text(cluster, page_key)
+            if not text:
+                log.warning("No text found for page %s", page_key)
+            drafts.append(Draft(rancher_server_name, cluster, page_key, text.splitlines()))
+        return drafts
+
+
+class Rancher2Merge(Rancher2Base):
+    """
+    Page made of the cluster drafts of pageTitle, grouped by rancher server.
+    Subclasses can change the draft lines with _prepare and _render.
+    """
+
+    def __init__(self, redmineClient, dryrun=False, drafts=None):
+        """
+        :param drafts: MergeDrafts shared by the merged pages of the run,
+        the drafts of this page are read on their own by default
+        """
+        self.drafts = drafts
+        super().__init__(redmineClient, dryrun)
+
+    def _get_drafts(self):
+        if self.drafts is None:
+            self.drafts = MergeDrafts(self.redmineClient, [self.pageTitle]).fetch()
+        return self.drafts
+
+    def _prepare(self, drafts):
+        """Called with all the drafts before they are rendered"""
+
+    def _render(self, draft):
+        """The lines of a Draft, as added to the merged page"""
+        return draft.lines
+
+    def set_content(self):
+        merge_drafts = self._get_drafts()
+        drafts = merge_drafts.drafts(self.pageTitle)
+        self._prepare(drafts)
+
+        merged_content = {name: [] for name in merge_drafts.servers}
+        for draft in drafts:
+            merged_content[draft.server].extend(self._render(draft))
+
+        for rancher_server_name, lines in merged_content.items():
+            rancher_url = merge_drafts.servers[rancher_server_name]
+            self.content.append(f'\nh2. "{rancher_server_name}":{rancher_url}dashboard\n')
+            self.content.extend(lines)
@@ -0,0 +1,118 @@
+from utils import api_timestamp
+
+# Node annotations read by the pages
+NODE_ANNOTATIONS = [
+    "alpha.kubernetes.io/provided-node-ip",
+    "management.cattle.io/pod-requests",
+    "management.cattle.io/pod-limits",
+]
+
+
+def _memory(resources):
+    """Keeps only the memory of container requests/limits"""
+    if not resources or "memory" not in resources:
+        return None
+    return {"memory": resources["memory"]}
+
+
+def compact_node(node):
+    """
+    Returns the fields of a raw (camelCase) node object that the pages use,
+    in the shape of the kubernetes models .to_dict()
+    """
+    metadata = node.get("metadata", {})
+    status = node.get("status", {})
+    node_info = status.get("nodeInfo", {})
+    annotations = metadata.get("annotations") or {}
+
+    return {
+        "metadata": {
+            "name": metadata.get("name"),
+            "creation_timestamp": api_timestamp(metadata.get("creationTimestamp")),
+            "annotations": {
+                key: annotations[key] for key in NODE_ANNOTATIONS if key in annotations
+            },
+        },
+        "spec": {
+            "taints": [
+                {"key": taint.get("key")}
+                for taint in node.get("spec", {}).get("taints") or []
+            ]
+            or None,
+        },
+        "status": {
+            "capacity": {"memory": (status.get("capacity") or {}).get("memory")},
+            "node_info": {
+                "container_runtime_version": node_info.get("containerRuntimeVersion"),
+                "os_image": node_info.get("osImage"),
+            },
+        },
+    }
+
+
+def compact_pod(pod):
+    """
+    Returns the fields of a raw (camelCase) pod object that the pods page
+    uses, in the shape of the kubernetes models .to_dict()
+    """
+    metadata = pod.get("metadata", {})
+    spec = pod.get("spec", {})
+    status = pod.get("status", {})
+    owner_references = metadata.get("ownerReferences") or []
+    labels = metadata.get("labels") or {}
+
+    containers = []
+    for container in spec.get("containers") or []:
+        resources = container.get("resources") or {}
+        containers.append(
+            {
+                "name": container.get("name"),
+                "resources": {
+                    "requests": _memory(resources.get("requests")),
+                    "limits": _memory(resources.get("limits")),
+                },
+            }
+        )
+
+    container_statuses = []
+    for container in status.get("containerStatuses") or []:
+        running = (container.get("state") or {}).get("running")
+        container_statuses.append(
+            {
+                "name": container.get("name"),
+                "image": container.get("image"),
+                "restart_count": container.get("restartCount", 0),
+                "started": container.get("started"),
+                "state": {
+                    "running": {"started_at": api_timestamp(running.get("startedAt"))}
+                    if running
+                    else None
+                },
+            }
+        )
+
+    return {
+        "metadata": {
+            "name": metadata.get("name"),
+            "namespace": metadata.get("namespace"),
+            "owner_references": [{"kind": owner_references[0].get("kind")}]
+            if owner_references
+            else None,
+            "labels": {"app.kubernetes.io/name": labels["app.kubernetes.io/name"]}
+            if "app.kubernetes.io/name" in labels
+            else None,
+        },
+        "spec": {"node_name": spec.get("nodeName"), "containers": containers},
+        "status": {
+            "phase": status.get("phase"),
+            "container_statuses": container_statuses,
+        },
+    }
+
+
+def node_key(node):
+    return node["metadata"]["name"]
+
+
+def pod_key(pod):
+    return (pod["metadata"]["namespace"], pod["metadata"]["name"])
@@ -0,0 +1,87 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from rancher2.listapps import HELM_RELEASES_SELECTOR
+from utils import get_field
+
+log = logging.getLogger(__name__)
+
+
+class ClusterSnapshot:
+    """
+    The nodes, pods, namespaces and helm releases of a cluster, listed once
+    and concurrently, shared by the apps, nodes and pods pages of a run.
+
+    A list that failed is None, the pages then list it themselves.
+    """
+
+    def __init__(self, rancher_client):
+        self.rancher_client = rancher_client
+        self._nodes = None
+        self._pods = None
+        self._namespaces = None
+        self._apps = None
+
+    def _list_pods(self):
+        pods_dict = defaultdict(list)
+        for pod in self.rancher_client.iter_pods():
+            node_name = get_field(pod, "spec", "node_name")
+            if node_name:
+                pods_dict[node_name].append(pod)
+        return pods_dict
+
+    def _list_apps(self):
+        apps_by_namespace = defaultdict(list)
+        for app in self.rancher_client.list_items(
+            self.rancher_client.v1.list_secret_for_all_namespaces,
+            label_selector=HELM_RELEASES_SELECTOR,
+        ):
+            apps_by_namespace[get_field(app, "metadata", "namespace")].append(app)
+        return apps_by_namespace
+
+    def fetch(self):
+        v1 = self.rancher_client.v1
+        lists = {
+            "_nodes": (self.rancher_client.list_items, v1.list_node),
+            "_pods": (self._list_pods,),
+            "_namespaces": (self.rancher_client.list_items, v1.list_namespace),
+            "_apps": (self._list_apps,),
+        }
+        with ThreadPoolExecutor(max_workers=len(lists)) as executor:
+            futures = {
+                name: executor.submit(*call) for name, call in lists.items()
+            }
+            for name, future in futures.items():
+                try:
+                    setattr(self, name, future.result())
+                except Exception:
+                    log.exception(
+                        "Cluster %s: failed to list %s",
+                        self.rancher_client.cluster_name,
+                        name.lstrip("_"),
+                    )
+        counts = [
+            "-" if items is None else len(items)
+            for items in (self._nodes, self._namespaces)
+        ]
+        for grouped in (self._pods, self._apps):
+            counts.append("-" if grouped is None else sum(map(len, grouped.values())))
+        log.info(
+            "Cluster %s: snapshot of %s nodes, %s namespaces, %s pods, %s apps",
+            self.rancher_client.cluster_name,
+            *counts,
+        )
+        return self
+
+    def nodes(self):
+        return self._nodes
+
+    def pods_by_node(self):
+        return self._pods
+
+    def namespaces(self):
+        return self._namespaces
+
+    def apps_by_namespace(self):
+        return self._apps
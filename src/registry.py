@@ -0,0 +1,247 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class RegistryAccessDenied(Exception):
+    """The registry answered with 401 Unauthorized"""
+
+
+class RegistryResponseError(Exception):
+    """The registry answer could not be used"""
+
+
+def new_session(pool_size=10):
+    """
+    Create a requests session with keep-alive connection pools large enough
+    to be shared by pool_size threads
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class RegistryTokenManager:
+    """
+    Caches registry bearer tokens per auth endpoint and repository scope
+    until they expire.
+    """
+
+    # tokens are renewed this many seconds before they expire
+    expiry_margin = 10
+
+    def __init__(self, get):
+        """
+        :param get: callable used to send the GET requests, with the same
+        signature as requests.get
+        """
+        self.get = get
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get_token(self, auth_url, service, scope):
+        """
+        Return a cached token or request a new one.
+
+        :return: the token or None if the auth endpoint refused the request
+        """
+        key = (auth_url, service, scope)
+        with self.lock:
+            cached = self.tokens.get(key)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
+        r = self.get(auth_url, params={"service": service, "scope": scope}, timeout=60)
+        if not r.status_code == 200:
+            return None
+
+        data = r.json()
+        token = data.get("token") or data.get("access_token")
+        if not token:
+            return None
+
+        # the token spec defaults to 60 seconds when expires_in is missing
+        expires_in = int(data.get("expires_in", 60))
+        with self.lock:
+            self.tokens[key] = (token, time.time() + expires_in - self.expiry_margin)
+        logging.debug(f"Obtained token for {scope}, valid {expires_in}s")
+
+        return token
+
+
+class RegistryDeferred(Exception):
+    """The registry is rate limiting us, the request was given up"""
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, with bursts of at most
+    capacity requests
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, returns the number of seconds to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def release(self):
+        """Give back a token that was reserved but not used"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def block(self, seconds):
+        """Do not allow any request for the next seconds"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RegistryScheduler:
+    """
+    Sends the requests to the registries, per registry host:
+    - no more than concurrency requests at once
+    - a token bucket limiting the request rate
+    - the RateLimit-Remaining and Retry-After headers pause the host
+    - failed requests are retried with a jittered exponential backoff
+
+    Instead of blocking the whole run, a request that would have to wait
+    more than max_wait seconds raises RegistryDeferred.
+    """
+
+    def __init__(
+        self,
+        session,
+        rate=10,
+        burst=20,
+        concurrency=4,
+        retries=3,
+        backoff=1,
+        max_wait=60,
+    ):
+        self.session = session
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.buckets = {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def _host_limits(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+                self.semaphores[host] = threading.BoundedSemaphore(self.concurrency)
+            return self.buckets[host], self.semaphores[host]
+
+    def _backoff_delay(self, attempt):
+        return self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def _retry_after(response):
+        """
+        Seconds to wait according to the response headers, None if there is
+        no reason to wait
+        """
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(0, float(retry_after))
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                    return max(0, retry_at.timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+
+        # e.g. "RateLimit-Remaining: 0;w=21600"
+        remaining = response.headers.get("RateLimit-Remaining")
+        if remaining:
+            values = dict(
+                item.split("=", 1) if "=" in item else ("count", item)
+                for item in remaining.replace(" ", "").split(";")
+            )
+            try:
+                if int(values["count"]) <= 0:
+                    return float(values.get("w", 60))
+            except (KeyError, ValueError):
+                pass
+
+        return None
+
+    def request(self, method, url, **kwargs):
+        host = urlparse(url).netloc
+        bucket, semaphore = self._host_limits(host)
+
+        with semaphore:
+            for attempt in range(self.retries + 1):
+                wait = bucket.reserve()
+                if wait > self.max_wait:
+                    bucket.release()
+                    raise RegistryDeferred(f"{host} is rate limited for {int(wait)}s")
+                if wait:
+                    time.sleep(wait)
+
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except requests.RequestException as exc:
+                    if attempt == self.retries:
+                        raise
+                    delay = self._backoff_delay(attempt)
+                    logging.warning(
+                        f"{method} {url} failed ({exc}), retrying in {delay:.1f}s"
+                    )
+                    time.sleep(delay)
+                    continue
+
+                retry_after = self._retry_after(response)
+                if retry_after is not None:
+                    bucket.block(retry_after)
+
+                if response.status_code in (429, 503):
+                    delay = retry_after or self._backoff_delay(attempt)
+                    if attempt == self.retries or delay > self.max_wait:
+                        raise RegistryDeferred(
+                            f"{host} answered {response.status_code}, retry in {int(delay)}s"
+                        )
+                    logging.warning(
+                        f"{host} is throttling requests, retrying in {delay:.1f}s"
+                    )
+                    bucket.block(delay)
+                    continue
+
+                if response.status_code >= 500 and attempt < self.retries:
+                    delay = self._backoff_delay(attempt)
+                    logging.warning(
+                        f"{method} {url} answered {response.status_code}, "
+                        f"retrying in {delay:.1f}s"
+                    )
+                    time.sleep(delay)
+                    continue
+
+                return response
@@ -161,4 +161,7 @@ if __name__ == "__main__":
     log.info("Running list containers")
     run_list_containers(image_checker, dry_run)
 
+    if os.getenv("BASE_IMAGE_GRAPH_DIR"):
+        image_checker.export_base_graph(os.getenv("BASE_IMAGE_GRAPH_DIR"))
+
     log.info("Finished running all scripts")
@@ -1,6 +1,8 @@
 import logging
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Force logging setup before any module can silently activate lastResort
 _handler = logging.StreamHandler(sys.stdout)
@@ -10,9 +12,13 @@ logging.root.setLevel(logging.INFO)
 
 import applytemplate as applytemplate
 from image_checker import ImageChecker
-from rancher2.listapps import Rancher2Apps, Rancher2MergeApps
+from rancher2.auth import RancherClient, RedmineClient, clients_to_list
+from rancher2.informer import ClusterStore, start_informers
+from rancher2.snapshot import ClusterSnapshot
+from rancher2.listapps import Rancher2Apps, Rancher2MergeApps, start_decode_pool
 from rancher2.listnodes import Rancher2MergeNodes, Rancher2Nodes
 from rancher2.listpods import Rancher2MergePods, Rancher2Pods
+from rancher2.merge import MergeDrafts
 
 log = logging.getLogger(__name__)
 
@@ -20,7 +26,7 @@ print("Rancher2 pipeline starting (logging configured)", flush=True)
 log.info("Rancher2 pipeline logging ready")
 
 
-def run_apply_template(page, dry_run=False):
+def run_apply_template(page, image_checker, dry_run=False):
     assert page, "Please provide a template"
 
     config = dict(
@@ -38,77 +44,210 @@ def run_apply_template(page, dry_run=False):
     assert config["wiki_server"], "Please set WIKI_SERVER env var"
     assert config["wiki_apikey"], "Please set WIKI_APIKEY env var"
 
-    applytemplate.main(page, config, ImageChecker())
+    applytemplate.main(page, config, image_checker)
 
 
-def run_list_apps(dry_run=False):
+def run_list_apps(dry_run=False, store=None, rancher_client=None):
     log.info("Starting list apps")
-    apps = Rancher2Apps(dry_run)
+    apps = Rancher2Apps(dry_run, store, rancher_client)
     apps.set_content()
     apps.write_page()
     log.info("Completed list apps")
+    return apps
 
 
-def run_list_nodes(dry_run=False):
+def run_list_nodes(dry_run=False, store=None, rancher_client=None):
     log.info("Starting list nodes")
-    nodes = Rancher2Nodes(dry_run)
+    nodes = Rancher2Nodes(dry_run, store, rancher_client)
     nodes.set_content()
     nodes.write_page()
     log.info("Completed list nodes")
+    return nodes
 
 
-def run_list_pods(dry_run=False):
+def run_list_pods(dry_run=False, store=None, rancher_client=None):
     log.info("Starting list pods")
-    pods = Rancher2Pods(dry_run)
+    pods = Rancher2Pods(dry_run, store, rancher_client)
     pods.set_content()
     pods.write_page()
     log.info("Completed list pods")
+    return pods
+
+
+def write_heartbeat(cluster_name, pages, dry_run=False):
+    """Records the draft pages written for the cluster, for the merge"""
+    page_names = [page_name for page in pages for page_name in page.pages_written]
+    if dry_run:
+        log.info("Would write the heartbeat of cluster %s: %s", cluster_name, page_names)
+        return
+    try:
+        RedmineClient().write_heartbeat(cluster_name, page_names)
+    except Exception:
+        log.exception("Failed to write the heartbeat of cluster %s", cluster_name)
+
+
+def run_list_cluster(rancher_client, dry_run=False):
+    """
+    Lists the cluster objects once, then builds the apps, nodes and pods
+    pages from this snapshot in parallel
+    """
+    log.info("Listing cluster %s", rancher_client.cluster_name)
+    snapshot = ClusterSnapshot(rancher_client).fetch()
+
+    steps = [run_list_apps, run_list_nodes, run_list_pods]
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        futures = {
+            step: executor.submit(
+                step, dry_run, store=snapshot, rancher_client=rancher_client
+            )
+            for step in steps
+        }
+        pages = []
+        for step, future in futures.items():
+            try:
+                pages.append(future.result())
+            except Exception:
+                log.exception(
+                    "Cluster %s: step %s failed, continuing with next step",
+                    rancher_client.cluster_name,
+                    step.__name__,
+                )
+    write_heartbeat(rancher_client.cluster_name, pages, dry_run)
+    log.info("Listed cluster %s", rancher_client.cluster_name)
+
+
+def run_list_clusters(rancher_clients, dry_run=False):
+    """
+    Lists several clusters at once, each one writes its own draft pages,
+    the run takes as long as the slowest cluster
+    """
+    workers = int(os.getenv("RANCHER2_LIST_WORKERS", len(rancher_clients) or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_list_cluster, rancher_client, dry_run): rancher_client
+            for rancher_client in rancher_clients
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                log.exception("Failed to list cluster %s", futures[future].cluster_name)
 
 
-def run_merge_apps(dry_run=False):
+def run_merge_apps(dry_run=False, drafts=None):
     log.info("Starting merge apps")
-    merged_apps = Rancher2MergeApps(dry_run)
+    merged_apps = Rancher2MergeApps(dry_run, drafts)
     merged_apps.set_content()
     merged_apps.write_page()
     log.info("Completed merge apps")
 
 
-def run_merge_nodes(dry_run=False):
+def run_merge_nodes(dry_run=False, drafts=None):
     log.info("Starting merge nodes")
-    merged_nodes = Rancher2MergeNodes(dry_run)
+    merged_nodes = Rancher2MergeNodes(dry_run, drafts)
     merged_nodes.set_content()
     merged_nodes.write_page()
     log.info("Completed merge nodes")
 
 
-def run_merge_pods(dry_run=False):
+def run_merge_pods(image_checker, dry_run=False, drafts=None):
     log.info("Starting merge pods")
-    merged_pods = Rancher2MergePods(dry_run)
+    merged_pods = Rancher2MergePods(dry_run, image_checker, drafts)
     merged_pods.set_content()
     merged_pods.write_page()
     log.info("Completed merge pods")
 
 
+def run_daemon(dry_run=False):
+    """
+    Keeps the nodes and pods of the cluster in memory with watches instead
+    of listing them on every run. The nodes and pods pages are written when
+    the cluster changed, at most every RANCHER2_DAEMON_MIN_INTERVAL seconds,
+    and at least every RANCHER2_DAEMON_INTERVAL seconds, with the apps page.
+    """
+    interval = int(os.getenv("RANCHER2_DAEMON_INTERVAL", 3600))
+    min_interval = int(os.getenv("RANCHER2_DAEMON_MIN_INTERVAL", 300))
+
+    store = ClusterStore()
+    rancher_client = RancherClient()
+    start_informers(rancher_client, store)
+    store.wait_synced()
+    log.info("Cluster store synced, writing pages")
+
+    last_full_run = 0
+    while True:
+        generation = store.generation
+        started = time.monotonic()
+
+        steps = [
+            (run_list_nodes, (dry_run, store, rancher_client)),
+            (run_list_pods, (dry_run, store, rancher_client)),
+        ]
+        if started - last_full_run >= interval:
+            steps.insert(0, (run_list_apps, (dry_run, None, rancher_client)))
+            last_full_run = started
+        pages = []
+        for step, args in steps:
+            try:
+                pages.append(step(*args))
+            except Exception:
+                log.exception("Step %s failed, continuing with next step", step.__name__)
+        write_heartbeat(rancher_client.cluster_name, pages, dry_run)
+
+        time.sleep(max(0, started + min_interval - time.monotonic()))
+        timeout = max(0, last_full_run + interval - time.monotonic())
+        if store.wait_for_change(generation, timeout) != generation:
+            log.info("Cluster changed, writing pages")
+
+
 if __name__ == "__main__":
+    if sys.argv[1] in ("list", "daemon"):
+        # before the list and informer threads start
+        start_decode_pool()
+
     if sys.argv[1] == "list":
         log.info("=== Rancher2 list pipeline starting ===")
-        for step in [run_list_apps, run_list_nodes, run_list_pods]:
+        if os.getenv("RANCHER2_CLUSTERS_TO_LIST"):
+            run_list_clusters(clients_to_list(os.getenv("RANCHER2_CLUSTERS_TO_LIST")))
+        else:
             try:
-                step()
+                run_list_cluster(RancherClient())
             except Exception:
-                log.exception("Step %s failed, continuing with next step", step.__name__)
+                log.exception("Failed to list the cluster")
         log.info("=== Rancher2 list pipeline finished ===")
 
+    if sys.argv[1] == "daemon":
+        log.info("=== Rancher2 list daemon starting ===")
+        run_daemon()
+
     if sys.argv[1] == "merge":
         log.info("=== Rancher2 merge pipeline starting ===")
-        for step in [run_merge_apps, run_merge_nodes, run_merge_pods]:
+        # one image checker per run, so images and base images are checked once
+        image_checker = ImageChecker()
+        # the apps, nodes and pods drafts of all the clusters, read at once
+        drafts = None
+        try:
+            drafts = MergeDrafts().fetch()
+        except Exception:
+            log.exception("Failed to read the drafts, each merge reads its own")
+        for step, args in [
+            (run_merge_apps, (False, drafts)),
+            (run_merge_nodes, (False, drafts)),
+            (run_merge_pods, (image_checker, False, drafts)),
+        ]:
             try:
-                step()
+                step(*args)
             except Exception:
                 log.exception("Step %s failed, continuing with next step", step.__name__)
 
         try:
-            run_apply_template(os.getenv("WIKI_PAGE", "Applications"))
+            run_apply_template(os.getenv("WIKI_PAGE", "Applications"), image_checker)
         except Exception:
             log.exception("Apply template step failed")
+
+        if os.getenv("BASE_IMAGE_GRAPH_DIR"):
+            try:
+                image_checker.export_base_graph(os.getenv("BASE_IMAGE_GRAPH_DIR"))
+            except Exception:
+                log.exception("Base images graph export failed")
         log.info("=== Rancher2 merge pipeline finished ===")
@@ -0,0 +1,55 @@
+from image_result import State
+
+REDMINE_ERROR_COLOR = "%{color:red}"
+REDMINE_MINOR_COLOR = "%{color:orange}"
+REDMINE_MAJOR_COLOR = "%{color:purple}"
+REDMINE_OK_COLOR = "%{color:green}"
+REDMINE_INFO_COLOR = "%{color:black}"
+
+
+def _label(result):
+    if result.current:
+        return f"{result.image}:{result.current}"
+    return result.image
+
+
+def _render_image(result):
+    label = _label(result)
+    state = result.state
+
+    if state is State.UP_TO_DATE:
+        return f"{label}: {REDMINE_OK_COLOR}Up to date%"
+    if state is State.MINOR_UPGRADE:
+        return f"{label}: {REDMINE_MINOR_COLOR}minor upgrade to {result.latest_minor}%"
+    if state is State.MAJOR_UPGRADE:
+        text = f"{label}: {REDMINE_MAJOR_COLOR}major upgrade to {result.latest_major}%"
+        if result.latest_minor:
+            text += f"; {REDMINE_MINOR_COLOR}minor upgrade to {result.image}:{result.latest_minor}%"
+        return text
+    if state is State.NON_SEMANTIC:
+        return f"{label}: {REDMINE_ERROR_COLOR}non semantic version%"
+    if state is State.DEFERRED:
+        return f"{label}: {REDMINE_INFO_COLOR}check deferred, registry is rate limiting%"
+    if state is State.INFO:
+        return f"{label}: {REDMINE_INFO_COLOR} {result.detail}%"
+    if state is State.UNAVAILABLE:
+        return f"{label}: {result.detail}"
+    if state is State.NOT_CHECKED:
+        return result.detail
+    return f"{label}: {REDMINE_ERROR_COLOR}{result.detail}%"
+
+
+def render_textile(result):
+    """
+    Redmine textile message of an image check, the base images results are
+    appended on a second line
+    """
+    text = _render_image(result)
+    if result.bases is not None:
+        text += "\n" + "".join(f"{_render_image(base)} " for base in result.bases)
+    return text
+
+
+def render_status(result):
+    """The (up to date, message) pair the pages were built from"""
+    return result.up_to_date, render_textile(result)
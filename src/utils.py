@@ -1,6 +1,8 @@
 import logging
 import re
 import time
+from datetime import datetime
+from functools import lru_cache
 
 log = logging.getLogger(__name__)
 
@@ -96,3 +98,56 @@ def cpu_unit_conversion(str_to_convert):
         return size * conversion_dict[unit]
     else:
         return 0
+
+
+@lru_cache(maxsize=256)
+def _camel_case(name):
+    first, *rest = name.split("_")
+    return first + "".join(word.title() for word in rest)
+
+
+def get_field(obj, *path, default=None):
+    """
+    Read a nested field of a kubernetes object given as a model .to_dict()
+    (snake_case keys) or as the raw API JSON (camelCase keys).
+
+    @param obj: The object
+    @param path: The keys to follow, in snake_case
+    @param default: Returned when a key is missing or null
+    @return The field value
+    """
+    for key in path:
+        if not isinstance(obj, dict):
+            return default
+        value = obj.get(key)
+        if value is None:
+            value = obj.get(_camel_case(key))
+        if value is None:
+            return default
+        obj = value
+    return obj
+
+
+def api_timestamp(value):
+    """
+    Timestamps are strings in the raw API JSON, convert them to datetimes
+    so that they are printed the same way as the ones of the models.
+
+    @param value: "2024-01-31T10:00:00Z", a datetime or a placeholder
+    @return The datetime, or value if it is not a timestamp string
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return value
+
+
+def wiki_title(*parts):
+    """
+    Redmine wiki page title made of the given parts, joined by "_". The
+    characters Redmine does not accept in a title ( e.g. the dots of the
+    node names ) are replaced by "-".
+    """
+    return re.sub(r"[,./?;:|\s]", "-", "_".join(str(part) for part in parts))
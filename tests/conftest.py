@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of src/ are imported flat, as in the docker image
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
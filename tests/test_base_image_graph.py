@@ -0,0 +1,23 @@
+from base_image_graph import BaseImageGraph
+from image_result import ImageResult, State
+
+
+def test_impact_counts_only_the_outdated_base_images():
+    graph = BaseImageGraph()
+    graph.add_edges("eeacms/app:1.0", ["python:3.11", "node:18", "redis:7"])
+    graph.add_edges("eeacms/worker:1.0", ["python:3.11"])
+    graph.set_status(
+        "python:3.11",
+        ImageResult("python", State.MINOR_UPGRADE, current="3.11", latest_minor="3.12"),
+    )
+    graph.set_status("node:18", ImageResult.error("library/node", "connection error"))
+    graph.set_status("redis:7", ImageResult("redis", State.UP_TO_DATE, current="7"))
+
+    exported = graph.to_dict()
+
+    assert [(item["image"], item["downstream"]) for item in exported["impact"]] == [
+        ("python:3.11", 2)
+    ]
+    assert [(item["image"], item["downstream"]) for item in exported["errors"]] == [
+        ("node:18", 1)
+    ]
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+import requests
+
+from fake_registry import FakeRegistrySession
+
+BUILDS_URL = (
+    "https://hub.docker.com/api/audit/v1/action/?include_related=true&limit=500"
+    "&object=%2Fapi%2Frepo%2Fv1%2Frepository%2Feeacms%2Fapp%2F"
+)
+
+
+def response(body):
+    return {"status": 200, "headers": {}, "body": json.dumps(body)}
+
+
+FIXTURES = {
+    "POST https://hub.docker.com/v2/users/login/": response({"token": "hub"}),
+    f"GET {BUILDS_URL}": response(
+        {"objects": [{"build_tag": "1.0", "resource_uri": "/api/build/1/"}]}
+    ),
+    "GET https://hub.docker.com/api/build/1/": response(
+        {"dockerfile": "FROM python:latest\nFROM node:18\n"}
+    ),
+}
+
+
+class UnreachableAuthSession(FakeRegistrySession):
+    """The token requests for the node repository fail to connect"""
+
+    def request(self, method, url, params=None, **kwargs):
+        if "repository:library/node:pull" in (params or {}).get("scope", ""):
+            raise requests.ConnectionError("connection refused")
+        return super().request(method, url, params=params, **kwargs)
+
+
+@pytest.fixture
+def image_checker(tmp_path, monkeypatch):
+    monkeypatch.setenv("IMAGE_CACHE_PATH", str(tmp_path / "image_checker.sqlite"))
+    monkeypatch.setenv("IMAGE_CHECKER_RETRIES", "0")
+    from image_checker import ImageChecker
+
+    return ImageChecker(session=UnreachableAuthSession(FIXTURES))
+
+
+def test_base_results_with_a_transient_error_are_not_persisted(image_checker):
+    base_results = image_checker.check_base_image("eeacms/app:1.0")
+
+    assert [result.detail for result in base_results] == [
+        "connection error when looking for image versions",
+        "'latest' tag is not upgradeable",
+    ]
+    assert image_checker.cache.get("status", "python:latest")
+    assert image_checker.cache.get("status", "node:18") is None
+    assert image_checker.cache.get("base", "eeacms/app:1.0") is None
+    assert ("base", "eeacms/app:1.0") not in image_checker.settled_images
@@ -0,0 +1,95 @@
+import base64
+import gzip
+import json
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("kubernetes")
+pytest.importorskip("redminelib")
+
+from rancher2 import listapps  # noqa: E402
+
+
+def helm_secret_release(chart_metadata):
+    """The data.release field of a helm release secret"""
+    release = {"name": "app", "info": {}, "chart": {"metadata": chart_metadata}}
+    helm_release = base64.b64encode(gzip.compress(json.dumps(release).encode()))
+    return base64.b64encode(helm_release).decode()
+
+
+def app(name, release):
+    return {
+        "metadata": {
+            "namespace": "apps",
+            "uid": name,
+            "resource_version": "1",
+            "labels": {"name": name, "status": "deployed"},
+        },
+        "data": {"release": release},
+    }
+
+
+class Store:
+    def __init__(self, apps):
+        self.apps = apps
+
+    def namespaces(self):
+        return [{"metadata": {"name": "apps"}, "status": {"phase": "Active"}}]
+
+    def apps_by_namespace(self):
+        return {"apps": self.apps}
+
+
+RANCHER_CLIENT = types.SimpleNamespace(
+    cluster_name="test", base_url="https://rancher/", cluster_id="c-test"
+)
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv("WIKI_APPS_PAGE", "Rancher2_apps")
+    monkeypatch.setenv("RANCHER2_CHARTS_CACHE_PATH", "")
+    monkeypatch.setenv("REDMINE_PAGES_CACHE_PATH", "")
+    monkeypatch.setenv("RANCHER2_DECODE_WORKERS", "2")
+    yield
+    if listapps._decode_pool is not None:
+        listapps._decode_pool.shutdown()
+        listapps._decode_pool = None
+
+
+def app_rows(apps):
+    page = listapps.Rancher2Apps(store=Store(apps), rancher_client=RANCHER_CLIENT)
+    page.set_content()
+    return [
+        [column.strip() for column in line.split("|")[2:5]]
+        for line in page.content
+        if line.startswith('|"')
+    ]
+
+
+@pytest.mark.parametrize("decode_pool", [False, True])
+def test_set_content_from_a_worker_thread(decode_pool):
+    if decode_pool:
+        listapps.start_decode_pool()
+    apps = [
+        app(f"app{i}", helm_secret_release({"name": f"chart{i}", "version": "1.0"}))
+        for i in range(3)
+    ]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        rows = executor.submit(app_rows, apps).result(timeout=60)
+
+    assert rows == [["deployed", f"chart{i}", "1.0"] for i in range(3)]
+
+
+def test_release_with_a_corrupt_payload_renders_unknown():
+    corrupt = base64.b64encode(base64.b64encode(b"\x1f\x8bnot gzip")).decode()
+    apps = [app("broken", corrupt), app("ok", helm_secret_release({"name": "chart"}))]
+
+    assert app_rows(apps) == [
+        ["deployed", "unknown", "unknown"],
+        ["deployed", "chart", "unknown"],
+    ]
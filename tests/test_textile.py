@@ -0,0 +1,72 @@
+import pytest
+
+from image_result import ImageResult, State
+from textile import render_textile
+
+# the messages ImageChecker returned before the results were structured
+BASELINE = [
+    (
+        ImageResult.unavailable("eeacms/app", "could not fetch tag creation details."),
+        "eeacms/app: could not fetch tag creation details.",
+    ),
+    (
+        ImageResult.unavailable("nginx", "could not fetch docker hub token"),
+        "nginx: could not fetch docker hub token",
+    ),
+    (
+        ImageResult.unavailable("eeacms/app:1.0", "could not fetch build history."),
+        "eeacms/app:1.0: could not fetch build history.",
+    ),
+    (
+        ImageResult.error(
+            "library/nginx", "connection error when looking for image versions"
+        ),
+        "library/nginx: %{color:red}connection error when looking for image versions%",
+    ),
+    (
+        ImageResult.error("nginx:latest", "'latest' tag is not upgradeable"),
+        "nginx:latest: %{color:red}'latest' tag is not upgradeable%",
+    ),
+    (
+        ImageResult(
+            "eeacms/app:1.0",
+            State.INFO,
+            detail="was built externally, no Dockerfile available.",
+        ),
+        "eeacms/app:1.0: %{color:black} was built externally, no Dockerfile available.%",
+    ),
+    (
+        ImageResult("eeacms/app", State.NON_SEMANTIC, current="develop"),
+        "eeacms/app:develop: %{color:red}non semantic version%",
+    ),
+    (
+        ImageResult("nginx", State.UP_TO_DATE, current="1.25"),
+        "nginx:1.25: %{color:green}Up to date%",
+    ),
+    (
+        ImageResult("nginx", State.MINOR_UPGRADE, current="1.24", latest_minor="1.25"),
+        "nginx:1.24: %{color:orange}minor upgrade to 1.25%",
+    ),
+    (
+        ImageResult(
+            "nginx",
+            State.MAJOR_UPGRADE,
+            current="1.24",
+            latest_minor="1.25",
+            latest_major="2.0",
+        ),
+        "nginx:1.24: %{color:purple}major upgrade to 2.0%; "
+        "%{color:orange}minor upgrade to nginx:1.25%",
+    ),
+]
+
+
+@pytest.mark.parametrize("result, message", BASELINE)
+def test_render_textile_matches_the_baseline_messages(result, message):
+    assert render_textile(result) == message
+
+
+def test_unavailable_results_survive_the_cache():
+    result = ImageResult.unavailable("nginx", "could not fetch docker hub token")
+
+    assert ImageResult.from_compact(result.to_compact()) == result